@@ -0,0 +1,308 @@
+"""ASGI entry point: the read-heavy pages on an async MySQL driver.
+
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+
+GET and HEAD requests for the catalog (/listbooks, /list_of_books), the loan
+page (/user_books), the dashboard (/user) and the admin views of a book and
+a user are served by coroutines querying MySQL through aiomysql. A worker
+waiting on the database keeps serving other requests, and a page whose
+queries don't depend on each other runs them at the same time on separate
+pooled connections. The handlers push a Flask request context built from
+the ASGI request, so they share the session cookie, login, CSRF token,
+flash messages, templates, caches, ETags and query metrics of the WSGI
+routes they stand in for.
+
+Every other request goes to the unchanged Flask app, run on a thread pool.
+
+A page whose ETag comes from a version stamp reads the stamp before the
+content (as the WSGI routes do). Read concurrently on two connections, the
+content could be older than the stamp, and that stale copy would then be
+confirmed by 304s until the next change.
+"""
+import asyncio
+import os
+import re
+import time
+
+import aiomysql
+from a2wsgi import WSGIMiddleware
+from flask import Response, flash, g, make_response, redirect, render_template, request, session, url_for
+
+import app as library
+from app import User, app
+
+app.config['ASYNC_MYSQL_POOL_MIN_SIZE'] = int(os.getenv('ASYNC_MYSQL_POOL_MIN_SIZE', 1))
+app.config['ASYNC_MYSQL_POOL_MAX_SIZE'] = int(os.getenv('ASYNC_MYSQL_POOL_MAX_SIZE', 20))
+# Threads running the WSGI app for the routes without an async handler
+app.config['ASGI_WSGI_THREADS'] = int(os.getenv('ASGI_WSGI_THREADS', 10))
+
+
+class AsyncMySQL:
+    """aiomysql pool for the async routes, opened at startup (or on first use)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.pool = None
+        self._lock = asyncio.Lock()
+
+    async def open(self):
+        async with self._lock:
+            if self.pool is None:
+                config = self.app.config
+                args = library.mysql._connect_args()
+                if 'database' in args:
+                    args['db'] = args.pop('database')
+                self.pool = await aiomysql.create_pool(
+                    minsize=config['ASYNC_MYSQL_POOL_MIN_SIZE'],
+                    maxsize=config['ASYNC_MYSQL_POOL_MAX_SIZE'],
+                    pool_recycle=config['MYSQL_POOL_MAX_LIFETIME'],
+                    # Every statement is a read; autocommit keeps them from
+                    # holding on to an old snapshot between requests
+                    autocommit=True,
+                    **args,
+                )
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+    async def query(self, sql, params=(), one=False):
+        """Run one statement on a pooled connection and return its rows (or first row)."""
+        if self.pool is None:
+            await self.open()
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(sql, params)
+                rows = await cur.fetchone() if one else await cur.fetchall()
+        metrics = app.extensions.get('query_metrics')
+        if metrics is not None:
+            metrics.record(sql, time.perf_counter() - started)
+        return rows
+
+
+db = AsyncMySQL(app)
+
+# (compiled path pattern, handler, admin only)
+ROUTES = []
+
+
+def route(pattern, admin=False):
+    def register(handler):
+        ROUTES.append((re.compile(f"^{pattern}$"), handler, admin))
+        return handler
+    return register
+
+
+async def authenticate():
+    """Log in the session's user like load_user(), without blocking on MySQL."""
+    user_id = session.get('_user_id')
+    if user_id is None:
+        return None
+    user = library.user_from_claims(user_id)
+    if user is None:
+        # As in load_user(), the cache may be older than claims just turned down
+        changed = session.get(library.auth_claims.SESSION_KEY) is not None and library.auth_versions.fresh()
+        if not changed:
+            user = library.user_cache.get(user_id)
+    if user is None:
+        row = await db.query(library.USER_AUTH, (user_id,), one=True)
+        if row is None:
+            return None
+        user = User(id=row['id'], role=row['role'], is_banned=row['is_banned'])
+        library.user_cache.set(user_id, user)
+        session[library.auth_claims.SESSION_KEY] = library.auth_claims.claims(row)
+    # Where Flask-Login keeps the request's user, so current_user works
+    g._login_user = user
+    return user
+
+
+async def search_books(**kwargs):
+    sql, params, sort_column, limit = library.book_search_query(**kwargs)
+    return library.book_search_page(await db.query(sql, params), sort_column, limit)
+
+
+async def available_books_page(query='', sort='title', after=None, available_only=True):
+    if sort not in library.BOOK_SORTS:
+        sort = 'title'
+    return await library.catalog_cache.get_or_build_async(
+        library.available_books_key(query, sort, after, available_only),
+        lambda: search_books(query=query, available_only=available_only, sort=sort, after=after),
+    )
+
+
+@route(r"/listbooks")
+async def listbooks():
+    query = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'title')
+    available_books, next_cursor = await available_books_page(query, sort, request.args.get('after'),
+                                                              available_only=False)
+    return render_template("list_book_users.html", available_books=available_books,
+                           q=query, sort=sort, next_cursor=next_cursor)
+
+
+@route(r"/list_of_books", admin=True)
+async def list_of_books():
+    query = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'title')
+    after = request.args.get('after')
+
+    stamps = ('books', library.catalog_cache.version.current(), query, sort, after or '')
+    cacheable, current = library.page_state(stamps)
+    if current:
+        return library.finish_page(Response(status=304), stamps, cacheable)
+    books, next_cursor = await search_books(query=query, available_only=False, sort=sort,
+                                            after=after, columns=library.BOOK_LIST_COLUMNS)
+    response = make_response(render_template("list_of_books.html", books=books, q=query, sort=sort,
+                                             next_cursor=next_cursor))
+    return library.finish_page(response, stamps, cacheable)
+
+
+@route(r"/user")
+async def user():
+    # The profile and the catalog page are independent: fetch them together
+    user_data, (available_books, next_cursor) = await asyncio.gather(
+        db.query(library.USER_PROFILE, (g._login_user.id,), one=True),
+        available_books_page(after=request.args.get('after')),
+    )
+    if user_data:
+        return render_template('user_dashboard.html', user=user_data, available_books=available_books,
+                               next_cursor=next_cursor, admin=g._login_user.is_admin())
+    flash('User information not found.')
+    return redirect(url_for('register'))
+
+
+@route(r"/user_books")
+async def user_books():
+    user_id = g._login_user.id
+    loans = await db.query(library.USER_BOOKS_STAMP, (user_id,), one=True)
+
+    stamps = ('user_books', str(user_id), loans and loans['loans_version'], loans and loans['queue_version'])
+    cacheable, current = library.page_state(stamps)
+    if current:
+        return library.finish_page(Response(status=304), stamps, cacheable)
+    books, holds = await asyncio.gather(
+        db.query(library.USER_LOANS, (user_id,)),
+        db.query(library.holds.USER_HOLDS, (user_id,)),
+    )
+    return library.finish_page(make_response(render_template('user_books.html', books=books, holds=holds)),
+                               stamps, cacheable)
+
+
+@route(r"/book/(?P<book_id>\d+)", admin=True)
+async def view_book(book_id):
+    book_id = int(book_id)
+    book_data = await db.query(library.BOOK_PROFILE, (book_id,), one=True)
+    if not book_data:
+        flash("Book not found.")
+        return redirect(url_for('addUser'))
+
+    stamps = ('book', book_id, book_data['version'])
+    cacheable, current = library.page_state(stamps)
+    if current:
+        return library.finish_page(Response(status=304), stamps, cacheable)
+    holders = await db.query(library.BOOK_HOLDERS, (book_id,))
+    response = make_response(render_template("view_book.html", book=book_data, user_books=holders))
+    return library.finish_page(response, stamps, cacheable)
+
+
+@route(r"/user/(?P<user_id>\d+)", admin=True)
+async def view_user(user_id):
+    user_id = int(user_id)
+    user_data = await db.query(library.USER_PROFILE, (user_id,), one=True)
+    if not user_data:
+        flash("User not found.")
+        return redirect(url_for('addUser'))
+    return library.conditional_page(lambda: render_template("view_user.html", user=user_data),
+                                    'user', user_id, user_data['version'], user_data['loans_version'],
+                                    library.photo_url(user_data['photo_filename']))
+
+
+def request_context(scope):
+    """A Flask request context for the ASGI HTTP request `scope`."""
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+    host = next((value for name, value in headers if name.lower() == 'host'), None)
+    if host is None and scope.get('server'):
+        host = "%s:%s" % scope['server']
+    client = scope.get('client')
+    return app.test_request_context(
+        scope['path'],
+        base_url=f"{scope.get('scheme', 'http')}://{host or 'localhost'}{scope.get('root_path', '')}",
+        query_string=scope['query_string'].decode('latin-1'),
+        method=scope['method'],
+        headers=headers,
+        environ_overrides={'REMOTE_ADDR': client[0] if client else None},
+    )
+
+
+async def dispatch(handler, admin, args):
+    """Run `handler` the way Flask would run the view it stands in for."""
+    try:
+        rv = app.preprocess_request()
+        if rv is None:
+            user = await authenticate()
+            if admin and (user is None or not user.is_admin()):
+                # As admin_required
+                flash("Unauthorized access.", "warning")
+                rv = redirect(url_for('login'))
+            elif user is None:
+                # As login_required
+                rv = app.login_manager.unauthorized()
+            else:
+                rv = await handler(**args)
+    except Exception as e:
+        rv = app.handle_user_exception(e)
+    return app.finalize_request(rv)
+
+
+class Application:
+    """ASGI app sending the routes in ROUTES to their handlers and the rest to Flask."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=app.config['ASGI_WSGI_THREADS'])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            for pattern, handler, admin in ROUTES:
+                match = pattern.match(scope['path'])
+                if match:
+                    return await self.serve(scope, send, handler, admin, match.groupdict())
+        await self.wsgi(scope, receive, send)
+
+    async def serve(self, scope, send, handler, admin, args):
+        with request_context(scope):
+            try:
+                response = await dispatch(handler, admin, args)
+            except Exception as e:
+                response = app.handle_exception(e)
+
+        body = b'' if scope['method'] == 'HEAD' else response.get_data()
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await db.open()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = Application(app)
@@ -0,0 +1,147 @@
+"""Authentication from session claims, without a query per request.
+
+At login the user's id, role, ban flag and auth version are stored in the
+session (a cookie signed with SECRET_KEY, so the client can't alter them).
+A request whose claims carry the user's current auth version is
+authenticated from them alone.
+
+users.auth_version is bumped whenever a user's role, ban status or
+existence changes, and the change is also written to auth_changes (one row
+per user, indexed by time). Every worker keeps the auth versions of the
+changed users in memory (AuthVersions) and refreshes them from auth_changes
+in the background. Claims with an older version are rejected, and the app
+then reloads the user from the database and issues new claims.
+
+A change made on another worker is seen within one refresh interval. While
+the refreshes are failing, nothing is trusted and every request falls back
+to the database.
+"""
+import threading
+import time
+
+from MySQLdb.cursors import DictCursor
+
+SESSION_KEY = '_auth'
+DELETED = -1
+
+ALL_CHANGES = "SELECT user_id, auth_version, changed_at FROM auth_changes"
+
+RECENT_CHANGES = """
+    SELECT user_id, auth_version, changed_at FROM auth_changes
+    WHERE changed_at >= %s - INTERVAL %s SECOND
+"""
+
+
+def claims(user):
+    """The claims of a users row (id, role, is_banned, auth_version)."""
+    return {'id': user['id'], 'role': user['role'], 'banned': bool(user['is_banned']),
+            'av': user['auth_version']}
+
+
+def auth_changed(cur, user_ids):
+    """Bump the auth version of existing users, in the caller's transaction."""
+    user_ids = sorted({int(user_id) for user_id in user_ids})
+    if not user_ids:
+        return
+    placeholders = ", ".join(["%s"] * len(user_ids))
+    cur.execute(f"UPDATE users SET auth_version = auth_version + 1 WHERE id IN ({placeholders})", user_ids)
+    cur.execute(f"""
+        INSERT INTO auth_changes (user_id, auth_version, changed_at)
+        SELECT id, auth_version, NOW(6) FROM users WHERE id IN ({placeholders})
+        ON DUPLICATE KEY UPDATE auth_version = VALUES(auth_version), changed_at = VALUES(changed_at)
+    """, user_ids)
+
+
+def user_deleted(cur, user_id):
+    """Record that a user is gone, in the transaction deleting them."""
+    cur.execute("""
+        INSERT INTO auth_changes (user_id, auth_version, changed_at) VALUES (%s, %s, NOW(6))
+        ON DUPLICATE KEY UPDATE auth_version = VALUES(auth_version), changed_at = VALUES(changed_at)
+    """, (user_id, DELETED))
+
+
+class AuthVersions:
+    """Auth versions of the users whose role, ban or existence changed.
+
+    Users missing from the map are still at version 0. `overlap` seconds of
+    changes are read again on every refresh, so a change committed a little
+    after its timestamp isn't skipped. A user invalidated in this process
+    stays distrusted until a refresh that started after the invalidation
+    (and so read the committed change) has finished.
+    """
+
+    def __init__(self, max_age, overlap=60):
+        self.max_age = max_age
+        self.overlap = overlap
+        self._versions = {}
+        self._since = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        # user_id -> sequence number of their latest invalidation
+        self._invalidated = {}
+        self._sequence = 0
+
+        # Metrics
+        self.refreshes = 0
+        self.trusted = 0
+        self.rejected = 0
+
+    def refresh(self, conn):
+        with self._lock:
+            started = self._sequence
+        cur = conn.cursor(cursorclass=DictCursor)
+        try:
+            if self._since is None:
+                cur.execute(ALL_CHANGES)
+            else:
+                cur.execute(RECENT_CHANGES, (self._since, self.overlap))
+            rows = cur.fetchall()
+            conn.commit()
+        finally:
+            cur.close()
+
+        with self._lock:
+            for row in rows:
+                # Invalidated while the rows were being read: this version may be older
+                if self._invalidated.get(row['user_id'], 0) <= started:
+                    self._versions[row['user_id']] = row['auth_version']
+                if self._since is None or row['changed_at'] > self._since:
+                    self._since = row['changed_at']
+            self._invalidated = {user_id: sequence for user_id, sequence in self._invalidated.items()
+                                 if sequence > started}
+            if self._since is None:
+                # Nothing has changed yet: read from the beginning next time
+                self._since = '1000-01-01'
+            self._refreshed_at = time.monotonic()
+            self.refreshes += 1
+
+    def fresh(self):
+        """Whether the map was refreshed recently enough to be trusted."""
+        return self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.max_age
+
+    def is_current(self, user_id, version):
+        """Whether claims with auth version `version` are still valid for the user."""
+        with self._lock:
+            current = self.fresh() and self._versions.get(int(user_id), 0) == version
+            if current:
+                self.trusted += 1
+            else:
+                self.rejected += 1
+            return current
+
+    def invalidate(self, user_id):
+        """Distrust the user's claims until the next refresh, after changing them in this process."""
+        with self._lock:
+            self._sequence += 1
+            self._versions[int(user_id)] = None
+            self._invalidated[int(user_id)] = self._sequence
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._versions),
+                'fresh': int(self.fresh()),
+                'refreshes': self.refreshes,
+                'trusted': self.trusted,
+                'rejected': self.rejected,
+            }
@@ -0,0 +1,399 @@
+"""Load test of the hot routes against a local MySQL/MariaDB.
+
+Boots `app` on a local port (or targets `--url`, e.g. a gunicorn started
+separately), seeds synthetic users and books into the configured database,
+then has `--concurrency` logged-in virtual users drive login, /user,
+/listbooks, borrowing, returning and (admins only) /addUser for
+`--duration` seconds. CSRF tokens are read from the pages like a browser
+would. Reports p50/p95/p99 latency, throughput and, from the Server-Timing
+header, queries and DB time per request. Run from the repository root,
+with the database settings in .env and `flask db-migrate` applied. The
+rate limits are turned off in the booted app; start a server targeted with
+`--url` with RATE_LIMITS_ENABLED=0 as well:
+
+    python benchmarks/load_routes.py --concurrency 16 --duration 30 --save-baseline baseline.json
+    python benchmarks/load_routes.py --concurrency 16 --duration 30 --baseline baseline.json
+
+With --baseline the run fails (exit status 1) when a route got slower or
+lower in throughput than the baseline allows, or runs more queries.
+Synthetic rows use the `bench-` prefix and are removed with --cleanup.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+import stats  # noqa: E402
+
+PREFIX = 'bench-'
+EMAIL_DOMAIN = 'bench.invalid'
+PASSWORD = 'bench password'
+# Large enough that borrowing never runs out of copies during a run
+SEED_STOCK = 1_000_000
+
+# Relative frequency of each operation in a virtual user's loop
+MIX = {
+    'login': 5,
+    'user': 25,
+    'listbooks': 30,
+    'borrow': 15,
+    'return': 15,
+    'addUser': 10,
+}
+
+CSRF_INPUT = re.compile(r'name="csrf_token"\s+value="([^"]+)"')
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# ------------------------synthetic data-----------
+
+def bench_stats(cur):
+    """What the synthetic rows add to the dashboard counters, as stats.record() deltas."""
+    cur.execute("SELECT COALESCE(SUM(amount + on_loan + on_hold), 0), COALESCE(SUM(on_loan), 0) "
+                "FROM books WHERE book_name LIKE %s", (PREFIX + '%',))
+    copies, on_loan = cur.fetchone()
+    cur.execute("SELECT COALESCE(SUM(books_on_loan > 0), 0), COALESCE(SUM(COALESCE(is_banned, 0)), 0) "
+                "FROM users WHERE email LIKE %s", (f"{PREFIX}%@{EMAIL_DOMAIN}",))
+    borrowers, banned = cur.fetchone()
+    return {stats.COPIES: int(copies), stats.ON_LOAN: int(on_loan),
+            stats.BORROWERS: int(borrowers), stats.BANNED: int(banned)}
+
+
+def record_bench_stats(cur, before):
+    # Only the synthetic rows' share of the counters changes; the rest of the
+    # statistics, such as the per-book loans of real books, are left alone
+    after = bench_stats(cur)
+    stats.record(cur, {name: after[name] - before[name] for name in after})
+
+
+def seed(conn, users, books, admins, hash_method):
+    """Insert the synthetic rows (idempotent) and return (user emails, admin emails, book ids)."""
+    cur = conn.cursor()
+    pwhash = generate_password_hash(PASSWORD, hash_method)
+    before = bench_stats(cur)
+
+    book_rows = [(f"{PREFIX}book {i:06d}", f"{PREFIX}author {i % 200:03d}", SEED_STOCK) for i in range(books)]
+    for start in range(0, len(book_rows), 1000):
+        cur.executemany("""
+            INSERT INTO books (book_name, author, amount, for_exchange) VALUES (%s, %s, %s, 1)
+            ON DUPLICATE KEY UPDATE amount = VALUES(amount), for_exchange = 1
+        """, book_rows[start:start + 1000])
+
+    user_emails = [f"{PREFIX}user-{i}@{EMAIL_DOMAIN}" for i in range(users)]
+    admin_emails = [f"{PREFIX}admin-{i}@{EMAIL_DOMAIN}" for i in range(admins)]
+    user_rows = ([(email.split('@')[0], pwhash, email, None) for email in user_emails]
+                 + [(email.split('@')[0], pwhash, email, 'admin') for email in admin_emails])
+    for start in range(0, len(user_rows), 1000):
+        cur.executemany("""
+            INSERT INTO users (username, password, email, role, is_banned) VALUES (%s, %s, %s, %s, 0)
+            ON DUPLICATE KEY UPDATE password = VALUES(password), role = VALUES(role), is_banned = 0
+        """, user_rows[start:start + 1000])
+    # Written around the routes, so the counters get the difference here
+    record_bench_stats(cur, before)
+    conn.commit()
+
+    cur.execute("SELECT id FROM books WHERE book_name LIKE %s", (PREFIX + '%',))
+    book_ids = [row[0] for row in cur.fetchall()]
+    cur.close()
+    return user_emails, admin_emails, book_ids
+
+
+def cleanup(conn):
+    cur = conn.cursor()
+    emails, names = f"{PREFIX}%@{EMAIL_DOMAIN}", PREFIX + '%'
+    before = bench_stats(cur)
+    for table in ('overdue_loans', 'user_books', 'book_holds'):
+        cur.execute(f"""
+            DELETE t FROM {table} t JOIN users u ON t.user_id = u.id
+            WHERE u.email LIKE %s
+        """, (emails,))
+        cur.execute(f"""
+            DELETE t FROM {table} t JOIN books b ON t.book_id = b.id
+            WHERE b.book_name LIKE %s
+        """, (names,))
+    cur.execute("""
+        DELETE s FROM book_loan_stats s JOIN books b ON s.book_id = b.id
+        WHERE b.book_name LIKE %s
+    """, (names,))
+    cur.execute("DELETE FROM users WHERE email LIKE %s", (emails,))
+    cur.execute("DELETE FROM books WHERE book_name LIKE %s", (names,))
+    # The bench copies, loans and borrowers no longer count on the dashboard
+    record_bench_stats(cur, before)
+    conn.commit()
+    cur.close()
+
+
+# ------------------------virtual users-----------
+
+class Client:
+    """One browser: keeps its session cookie and the last CSRF token it saw."""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.cookies = {}
+        self.csrf_token = None
+        self.conn = None
+
+    def request(self, method, path, form=None):
+        body = urlencode(form) if form is not None else None
+        headers = {'Cookie': "; ".join(f"{k}={v}" for k, v in self.cookies.items())}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                content = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # The server closed a kept-alive connection; retry once on a new one
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        if response.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+            self.conn = None
+
+        for header in response.msg.get_all('Set-Cookie') or []:
+            name, _, rest = header.partition('=')
+            self.cookies[name.strip()] = rest.split(';', 1)[0]
+        text = content.decode('utf-8', 'replace')
+        token = CSRF_INPUT.search(text)
+        if token:
+            self.csrf_token = token.group(1)
+
+        timing = SERVER_TIMING.search(response.getheader('Server-Timing') or '')
+        return response.status, response.getheader('Location') or '', timing
+
+    def post(self, path, form):
+        return self.request('POST', path, dict(form, csrf_token=self.csrf_token or ''))
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, operation, seconds, ok, timing):
+        with self.lock:
+            samples = self.samples.setdefault(operation, {'latencies': [], 'errors': 0, 'queries': [], 'db_ms': []})
+            samples['latencies'].append(seconds)
+            samples['errors'] += not ok
+            if timing:
+                samples['db_ms'].append(float(timing.group(1)))
+                samples['queries'].append(int(timing.group(2)))
+
+    def summary(self, duration):
+        report = {}
+        for operation, samples in sorted(self.samples.items()):
+            latencies = samples['latencies']
+            queries = samples['queries']
+            report[operation] = {
+                'requests': len(latencies),
+                'errors': samples['errors'],
+                'throughput_rps': len(latencies) / duration,
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'queries_per_request': sum(queries) / len(queries) if queries else None,
+                'db_ms_per_request': sum(samples['db_ms']) / len(samples['db_ms']) if samples['db_ms'] else None,
+            }
+        return report
+
+
+def virtual_user(base_url, email, is_admin, book_ids, results, stop, record_after):
+    client = Client(base_url)
+    held = {}
+    operations = [op for op in MIX if is_admin or op != 'addUser']
+    weights = [MIX[op] for op in operations]
+
+    # A request counts as an error unless it got `status` and, for redirects, went to `location`
+    def timed(operation, send, status=200, location=None):
+        started = time.monotonic()
+        try:
+            got_status, got_location, timing = send()
+            ok = got_status == status and (location is None or urlsplit(got_location).path == location)
+        except (http.client.HTTPException, OSError):
+            ok, timing = False, None
+        if time.monotonic() >= record_after:
+            results.add(operation, time.monotonic() - started, ok, timing)
+        return ok
+
+    def login():
+        client.request('GET', '/')
+        return timed('login', lambda: client.post('/', {'email': email, 'password': PASSWORD}), 302, '/user')
+
+    login()
+    client.request('GET', '/listbooks')  # CSRF token of the logged-in session
+
+    while time.monotonic() < stop:
+        operation = random.choices(operations, weights)[0]
+        if operation == 'return' and not held:
+            operation = 'borrow'
+
+        if operation == 'login':
+            login()
+        elif operation == 'user':
+            timed('user', lambda: client.request('GET', '/user'))
+        elif operation == 'listbooks':
+            timed('listbooks', lambda: client.request('GET', '/listbooks'))
+        elif operation == 'borrow':
+            book_id = random.choice(book_ids)
+            if timed('borrow', lambda: client.post('/add_book_to_profile',
+                                                   {'book_id': book_id, f'quantity_{book_id}': 1}),
+                     302, '/user_books'):
+                held[book_id] = held.get(book_id, 0) + 1
+        elif operation == 'return':
+            book_id = random.choice(list(held))
+            if timed('return', lambda: client.post('/delete_book_from_profile',
+                                                   {'book_id': book_id, 'quantity_to_remove': 1}),
+                     302, '/user_books'):
+                held[book_id] -= 1
+                if not held[book_id]:
+                    del held[book_id]
+        elif operation == 'addUser':
+            tag = uuid.uuid4().hex[:12]
+            timed('addUser', lambda: client.post('/addUser', {
+                'username': f"{PREFIX}added-{tag}",
+                'password': PASSWORD,
+                'email': f"{PREFIX}added-{tag}@{EMAIL_DOMAIN}",
+            }), 302, '/addUser')
+
+
+# ------------------------baseline comparison-----------
+
+def compare(report, baseline, tolerance):
+    """Return a message for every route that regressed against the baseline."""
+    problems = []
+    for operation, base in baseline.items():
+        current = report.get(operation)
+        if current is None:
+            problems.append(f"{operation}: not measured in this run")
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            problems.append(f"{operation}: p95 {current['p95_ms']:.1f} ms, baseline {base['p95_ms']:.1f} ms")
+        if current['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            problems.append(f"{operation}: {current['throughput_rps']:.1f} req/s, "
+                            f"baseline {base['throughput_rps']:.1f} req/s")
+        # Query counts don't depend on the machine, so any real increase is a regression
+        if (current['queries_per_request'] is not None and base['queries_per_request'] is not None
+                and current['queries_per_request'] > base['queries_per_request'] + 0.5):
+            problems.append(f"{operation}: {current['queries_per_request']:.1f} queries per request, "
+                            f"baseline {base['queries_per_request']:.1f}")
+        if current['errors'] > base['errors']:
+            problems.append(f"{operation}: {current['errors']} errors, baseline {base['errors']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default=None, help='target a running server instead of booting the app')
+    parser.add_argument('--concurrency', type=int, default=16, help='simultaneous virtual users')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of load')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds before results are recorded')
+    parser.add_argument('--users', type=int, default=200, help='synthetic users to seed')
+    parser.add_argument('--admins', type=int, default=2, help='synthetic admins to seed')
+    parser.add_argument('--books', type=int, default=5000, help='synthetic books to seed')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare against')
+    parser.add_argument('--save-baseline', default=None, help='write this run\'s report to a JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--cleanup', action='store_true', help='remove the synthetic rows and exit')
+    args = parser.parse_args()
+
+    # A few virtual users log in and borrow far faster than the rate limits allow
+    os.environ.setdefault('RATE_LIMITS_ENABLED', '0')
+    from app import app, catalog_cache, mysql, user_list_version
+
+    with app.app_context():
+        if args.cleanup:
+            cleanup(mysql.connection)
+            catalog_cache.bump()
+            user_list_version.bump()
+            print("Synthetic rows removed.")
+            return
+        user_emails, admin_emails, book_ids = seed(mysql.connection, args.users, args.books, args.admins,
+                                                   app.config['PASSWORD_HASH_METHOD'])
+    catalog_cache.bump()
+    user_list_version.bump()
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        # Keep-alive connections, like a browser behind a proxy
+        WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    accounts = ([(email, True) for email in admin_emails]
+                + [(email, False) for email in random.sample(user_emails, min(len(user_emails), args.concurrency))])
+    accounts = accounts[:args.concurrency]
+
+    results = Results()
+    started = time.monotonic()
+    record_after = started + args.warmup
+    stop = record_after + args.duration
+    threads = [threading.Thread(target=virtual_user,
+                                args=(base_url, email, is_admin, book_ids, results, stop, record_after))
+               for email, is_admin in accounts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if server is not None:
+        server.shutdown()
+
+    report = results.summary(args.duration)
+    total = sum(route['requests'] for route in report.values())
+    print(f"{len(accounts)} virtual users, {args.duration:.0f}s, {total / args.duration:.1f} requests/s in total")
+    for operation, route in report.items():
+        queries = route['queries_per_request']
+        print(f"{operation}:")
+        print(f"  requests: {route['requests']} ({route['errors']} errors), {route['throughput_rps']:.1f}/s")
+        print(f"  latency p50/p95/p99: {route['p50_ms']:.1f} / {route['p95_ms']:.1f} / {route['p99_ms']:.1f} ms")
+        if queries is not None:
+            print(f"  queries per request: {queries:.1f}, DB time {route['db_ms_per_request']:.1f} ms")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems:
+            raise SystemExit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Login throughput with password checks inline vs. on the hashing pool.
+
+Simulates a login spike: `--concurrency` request threads each verify
+passwords back to back for `--duration` seconds, while a probe thread
+measures how long a cheap request (a few milliseconds of Python work)
+takes to get through. A login turned away with HashingBusy is counted and
+waits `--retry-after` seconds before trying again, like a client honouring
+the 503's Retry-After header. Run from the repository root:
+
+    python benchmarks/login_hashing.py --concurrency 16 --workers 4
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from hashing import HashingBusy, PasswordHasher  # noqa: E402
+
+
+def cheap_request():
+    return sum(i * i for i in range(20000))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(hasher, pwhash, concurrency, duration, retry_after):
+    stop = time.monotonic() + duration
+    logins = []
+    rejections = []
+    probe_latencies = []
+
+    def login_worker():
+        while time.monotonic() < stop:
+            started = time.monotonic()
+            try:
+                hasher.verify(pwhash, 'correct horse battery staple')
+            except HashingBusy:
+                rejections.append(started)
+                time.sleep(max(0.0, min(retry_after, stop - time.monotonic())))
+                continue
+            logins.append(time.monotonic() - started)
+
+    def probe():
+        while time.monotonic() < stop:
+            started = time.monotonic()
+            cheap_request()
+            probe_latencies.append(time.monotonic() - started)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=login_worker) for _ in range(concurrency)]
+    threads.append(threading.Thread(target=probe))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'logins_per_second': len(logins) / duration,
+        'login_p50_ms': percentile(logins, 0.50) * 1000,
+        'login_p95_ms': percentile(logins, 0.95) * 1000,
+        'rejected': len(rejections),
+        'probe_p50_ms': percentile(probe_latencies, 0.50) * 1000,
+        'probe_p95_ms': percentile(probe_latencies, 0.95) * 1000,
+        'probe_mean_ms': statistics.mean(probe_latencies) * 1000 if probe_latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=8, help='simultaneous login threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per scenario')
+    parser.add_argument('--workers', type=int, default=2, help='processes in the hashing pool')
+    parser.add_argument('--max-pending', type=int, default=None, help='queue bound of the pool')
+    parser.add_argument('--method', default='scrypt', help='werkzeug hash method')
+    parser.add_argument('--retry-after', type=float, default=2.0,
+                        help='seconds a rejected login waits before trying again (the Retry-After of the 503)')
+    args = parser.parse_args()
+
+    pwhash = generate_password_hash('correct horse battery staple', args.method)
+
+    scenarios = [
+        ('inline', PasswordHasher(workers=0, max_pending=args.concurrency, method=args.method)),
+        (f'pool ({args.workers} workers)',
+         PasswordHasher(workers=args.workers, max_pending=args.max_pending, method=args.method)),
+    ]
+    for name, hasher in scenarios:
+        if hasher.workers:
+            # Start the worker processes before the clock runs
+            hasher.verify(pwhash, 'warm up')
+        result = run(hasher, pwhash, args.concurrency, args.duration, args.retry_after)
+        hasher.shutdown()
+
+        print(f"{name}:")
+        for key, value in result.items():
+            print(f"  {key}: {value:.1f}" if isinstance(value, float) else f"  {key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
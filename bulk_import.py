@@ -0,0 +1,315 @@
+"""Streaming CSV/JSONL imports for the admin tools.
+
+Rows are parsed one at a time from the uploaded (or local) file and
+written in executemany batches, so an import never holds more than one
+batch in memory. Importers are generators yielding progress events (plain
+dicts) that the caller streams back or prints.
+"""
+import csv
+import json
+from datetime import datetime
+
+from MySQLdb import DataError, IntegrityError
+
+import stats
+from hashing import HashingBusy
+
+# Largest value of an INT column
+INT_MAX = 2**31 - 1
+
+
+def detect_format(filename):
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def _decoded(stream):
+    """The lines of a binary stream as text, decoded one at a time."""
+    for line_number, line in enumerate(stream, 1):
+        yield line.decode('utf-8-sig' if line_number == 1 else 'utf-8')
+
+
+def read_rows(stream, fmt):
+    """Yield (line_number, row, error) for every record of a binary stream.
+
+    A CSV file that can't be read further (bytes that aren't UTF-8, a
+    malformed record) ends with an error for the line it stopped at.
+    """
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            try:
+                line = line.decode('utf-8-sig' if line_number == 1 else 'utf-8').strip()
+            except UnicodeDecodeError:
+                yield line_number, None, 'not valid UTF-8'
+                continue
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, None, 'invalid JSON'
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, 'expected a JSON object'
+                continue
+            yield line_number, row, None
+    else:
+        reader = csv.DictReader(_decoded(stream))
+        try:
+            for row in reader:
+                yield reader.line_num, row, None
+        except UnicodeDecodeError:
+            yield reader.line_num + 1, None, 'not valid UTF-8, import stopped'
+        except csv.Error as e:
+            yield reader.line_num + 1, None, f'unreadable CSV ({e}), import stopped'
+
+
+def _text(row, field):
+    value = row.get(field)
+    return str(value).strip() if value is not None else ''
+
+
+def clean_book(row):
+    """Return ((book_name, author, amount, for_exchange), None) or (None, error)."""
+    book_name = _text(row, 'book_name')
+    author = _text(row, 'author')
+    if not book_name or not author:
+        return None, 'book_name and author are required'
+    if len(book_name) > 255 or len(author) > 255:
+        return None, 'book_name and author must be at most 255 characters'
+
+    try:
+        amount = int(_text(row, 'amount') or 1)
+    except ValueError:
+        return None, 'amount must be a whole number'
+    if amount < 1:
+        return None, 'amount must be at least 1'
+    if amount > INT_MAX:
+        return None, f'amount must be at most {INT_MAX}'
+
+    for_exchange = _text(row, 'for_exchange').lower()
+    if for_exchange in ('', 'none', 'null'):
+        for_exchange = None
+    else:
+        for_exchange = for_exchange in ('1', 'true', 'yes', 'y')
+
+    return (book_name, author, amount, for_exchange), None
+
+
+def import_books(conn, rows, batch_size=1000):
+    """Upsert books from read_rows() output, committing every `batch_size` rows.
+
+    Duplicates of an existing (book_name, author) are merged by the unique
+    index: their copies are added to the existing amount. If a merge would
+    take a book past INT_MAX copies, that batch is retried row by row and
+    the rows that overflow are rejected.
+    """
+    cur = conn.cursor()
+    batch = []
+    totals = {'processed': 0, 'inserted': 0, 'merged': 0, 'errors': 0}
+
+    upsert = """
+        INSERT INTO books (book_name, author, amount, for_exchange)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE amount = amount + VALUES(amount), version = version + 1
+    """
+
+    def flush():
+        # Affected rows count 1 per inserted row and 2 per merged one
+        rows = [values for _, values in batch]
+        try:
+            cur.executemany(upsert, rows)
+            # Read before the stats write below replaces it
+            affected = cur.rowcount
+            stats.record(cur, {stats.COPIES: sum(values[2] for values in rows)})
+            conn.commit()
+        except DataError:
+            conn.rollback()
+        else:
+            merged = max(affected - len(rows), 0)
+            totals['merged'] += merged
+            totals['inserted'] += len(rows) - merged
+            batch.clear()
+            return
+
+        for line_number, values in batch:
+            try:
+                cur.execute(upsert, values)
+                affected = cur.rowcount
+                stats.record(cur, {stats.COPIES: values[2]})
+                conn.commit()
+            except DataError:
+                conn.rollback()
+                totals['errors'] += 1
+                yield {'line': line_number, 'error': f'the book would have more than {INT_MAX} copies'}
+                continue
+            totals['merged' if affected > 1 else 'inserted'] += 1
+        batch.clear()
+
+    try:
+        for line_number, row, error in rows:
+            totals['processed'] += 1
+            if row is not None:
+                values, error = clean_book(row)
+            if error:
+                totals['errors'] += 1
+                yield {'line': line_number, 'error': error}
+                continue
+
+            batch.append((line_number, values))
+            if len(batch) >= batch_size:
+                yield from flush()
+                yield {'progress': dict(totals)}
+
+        if batch:
+            yield from flush()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    yield {'done': dict(totals)}
+
+
+USER_FIELDS = ('username', 'password', 'email', 'first_name', 'second_name', 'dob', 'address', 'photo_filename')
+
+# VARCHAR lengths of the users columns (migrations/0001)
+USER_FIELD_LENGTHS = {'username': 50, 'email': 100, 'first_name': 255, 'second_name': 255, 'address': 255,
+                      'photo_filename': 255}
+
+# {placeholders} is one %s per email
+TAKEN_EMAILS = "SELECT email FROM users WHERE email IN ({placeholders})"
+
+
+def clean_user(row, photo_exists):
+    """Return (values dict, None) or (None, error) for one user row."""
+    user = {field: _text(row, field) for field in USER_FIELDS}
+
+    if not user['username'] or not user['password'] or not user['email']:
+        return None, 'username, password and email are required'
+    for field, length in USER_FIELD_LENGTHS.items():
+        if len(user[field]) > length:
+            return None, f'{field} must be at most {length} characters'
+    if '@' not in user['email']:
+        return None, 'invalid email'
+
+    if user['dob']:
+        try:
+            user['dob'] = datetime.strptime(user['dob'], '%Y-%m-%d').date()
+        except ValueError:
+            return None, 'dob must use the YYYY-MM-DD format'
+    else:
+        user['dob'] = None
+
+    if user['photo_filename']:
+        if not photo_exists(user['photo_filename']):
+            return None, f"photo {user['photo_filename']} has not been uploaded"
+    else:
+        user['photo_filename'] = None
+
+    return user, None
+
+
+def import_users(conn, rows, hash_passwords, batch_size=500, photo_exists=lambda name: False):
+    """Create users from read_rows() output, yielding one result per row.
+
+    Passwords of a whole batch are hashed by `hash_passwords` (a list of
+    passwords -> their hashes, e.g. PasswordHasher.hash_many), then the
+    batch is written with one executemany. If hashing times out, the import
+    stops with an error for the batch's first row. Emails
+    that already exist are skipped with an error. If the batch insert still
+    hits the unique email index (e.g. a concurrent registration) or a value
+    the columns reject, that batch is retried row by row so every row gets
+    its own result.
+    """
+    cur = conn.cursor()
+    batch = []
+    totals = {'processed': 0, 'created': 0, 'errors': 0}
+
+    insert = """
+        INSERT INTO users (username, password, email, first_name, second_name, dob, address, photo_filename)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """
+
+    def values(user, hashed):
+        return (user['username'], hashed, user['email'], user['first_name'], user['second_name'],
+                user['dob'], user['address'], user['photo_filename'])
+
+    def flush():
+        results = []
+        placeholders = ", ".join(["%s"] * len(batch))
+        cur.execute(TAKEN_EMAILS.format(placeholders=placeholders), [user['email'] for _, user in batch])
+        taken = {row[0].lower() for row in cur.fetchall()}
+
+        pending = []
+        for line_number, user in batch:
+            email = user['email'].lower()
+            if email in taken:
+                results.append({'line': line_number, 'email': user['email'],
+                                'error': 'email is already registered'})
+            else:
+                taken.add(email)
+                pending.append((line_number, user))
+
+        hashed = hash_passwords([user['password'] for _, user in pending])
+        rows_to_insert = [values(user, password) for (_, user), password in zip(pending, hashed)]
+
+        if rows_to_insert:
+            try:
+                cur.executemany(insert, rows_to_insert)
+                conn.commit()
+                results.extend({'line': line_number, 'email': user['email'], 'status': 'created'}
+                               for line_number, user in pending)
+            except (IntegrityError, DataError):
+                conn.rollback()
+                for (line_number, user), row in zip(pending, rows_to_insert):
+                    try:
+                        cur.execute(insert, row)
+                        conn.commit()
+                        results.append({'line': line_number, 'email': user['email'], 'status': 'created'})
+                    except IntegrityError:
+                        conn.rollback()
+                        results.append({'line': line_number, 'email': user['email'],
+                                        'error': 'email or username is already registered'})
+                    except DataError as e:
+                        conn.rollback()
+                        results.append({'line': line_number, 'email': user['email'],
+                                        'error': f'invalid value ({e.args[-1]})'})
+
+        batch.clear()
+        results.sort(key=lambda result: result['line'])
+        for result in results:
+            totals['created' if 'status' in result else 'errors'] += 1
+        return results
+
+    try:
+        for line_number, row, error in rows:
+            totals['processed'] += 1
+            if row is not None:
+                user, error = clean_user(row, photo_exists)
+            if error:
+                totals['errors'] += 1
+                yield {'line': line_number, 'error': error}
+                continue
+
+            batch.append((line_number, user))
+            if len(batch) >= batch_size:
+                yield from flush()
+
+        if batch:
+            yield from flush()
+    except HashingBusy as e:
+        # Earlier batches are committed: end the stream with the first row not imported
+        conn.rollback()
+        totals['errors'] += len(batch)
+        yield {'line': batch[0][0], 'error': f"{e}, import stopped"}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    yield {'done': dict(totals)}
@@ -0,0 +1,143 @@
+"""Cache of catalog pages, invalidated by a catalog version counter.
+
+Every route that changes the books table bumps the version. Cached pages
+are keyed by (version, page key), so a bump makes every page built before
+it unreachable at once. With FileVersion all worker processes of a host
+share the counter and see a bump immediately.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalVersion:
+    """Catalog version kept in this process only."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def current(self):
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+
+
+class FileVersion:
+    """Catalog version shared through a file, for every process on the host.
+
+    Bumping appends one byte (a single atomic O_APPEND write, no locking)
+    and the version is the file's (inode, size), so reading it is one
+    stat(). Once the file grows past `max_size` it is replaced by an empty
+    one, which is a new version too because the inode changes.
+    """
+
+    def __init__(self, path, max_size=1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        # Make sure there is a file to stat
+        open(self.path, 'ab').close()
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size)
+
+    def bump(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, b"+")
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+        if size > self.max_size:
+            tmp_path = f"{self.path}.{os.getpid()}"
+            open(tmp_path, 'wb').close()
+            os.replace(tmp_path, self.path)
+
+
+class CatalogCache:
+    """LRU cache of catalog pages for the current catalog version."""
+
+    def __init__(self, version, maxsize=256):
+        self.version = version
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._seen_version = None
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.rebuild_time = 0.0
+        self.max_rebuild_time = 0.0
+
+    def get_or_build(self, key, build):
+        """Return the cached value of `key`, calling `build()` on a miss."""
+        version, entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        started = time.monotonic()
+        value = build()
+        self._store(key, value, version, time.monotonic() - started)
+        return value
+
+    async def get_or_build_async(self, key, build):
+        """get_or_build() for a coroutine function `build`."""
+        version, entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        started = time.monotonic()
+        value = await build()
+        self._store(key, value, version, time.monotonic() - started)
+        return value
+
+    def _lookup(self, key):
+        version = self.version.current()
+        with self._lock:
+            if version != self._seen_version:
+                # Pages of older versions can never be served again
+                self._entries.clear()
+                self._seen_version = version
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return version, entry
+            self.misses += 1
+        return version, None
+
+    def _store(self, key, value, version, elapsed):
+        with self._lock:
+            self.rebuild_time += elapsed
+            self.max_rebuild_time = max(self.max_rebuild_time, elapsed)
+            # If the catalog changed while building, the value may already be stale
+            if version is not None and version == self._seen_version:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+    def bump(self):
+        self.version.bump()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'total_rebuild_seconds': self.rebuild_time,
+            'avg_rebuild_seconds': self.rebuild_time / self.misses if self.misses else 0.0,
+            'max_rebuild_seconds': self.max_rebuild_time,
+        }
@@ -0,0 +1,519 @@
+"""MySQL connection pool used in place of flask_mysqldb.MySQL.
+
+flask_mysqldb opens (and authenticates) a new connection in every app
+context. PooledMySQL keeps the same `mysql.connection` interface, but the
+connection is checked out of a per-process pool the first time a request
+touches it and handed back at teardown.
+
+With read replicas configured, `mysql.reader` is a connection to one of
+them for reads that may lag slightly behind the primary. Replicas lagging
+too far are skipped. For a short while after a session writes, its reads
+go to the primary so it sees its own changes.
+"""
+import os
+import random
+import threading
+import time
+
+import MySQLdb
+from flask import g, has_request_context, request, session
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the checkout timeout."""
+
+
+class _PooledConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """Thread-safe pool of MySQLdb connections.
+
+    Between `min_size` and `max_size` connections are kept open. Connections
+    older than `max_lifetime` seconds are replaced, and ones idle for longer
+    than `health_check_interval` seconds are pinged before being handed out.
+    A checkout waits at most `checkout_timeout` seconds for a free
+    connection before raising PoolTimeout. Connections are opened by calling
+    `connect(**connect_args)`.
+    """
+
+    def __init__(self, connect_args, min_size=1, max_size=10, max_lifetime=3600,
+                 health_check_interval=30, checkout_timeout=5, connect=MySQLdb.connect):
+        self.connect_args = connect_args
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        # Metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.recycled = 0
+        self.failed_health_checks = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _connect(self):
+        entry = _PooledConnection(self.connect(**self.connect_args))
+        self.connects += 1
+        return entry
+
+    def fill(self):
+        """Open connections until the pool holds `min_size` of them."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                entry = self._connect()
+            except MySQLdb.Error:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def acquire(self, timeout=None):
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        entry = None
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Reserve a slot, the connection is opened outside the lock
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"no MySQL connection free after {timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self.checkouts += 1
+            wait_time = time.monotonic() - started
+            if waited:
+                self.waits += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        try:
+            if entry is None:
+                entry = self._connect()
+            else:
+                entry = self._validate(entry)
+        except MySQLdb.Error:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return entry
+
+    def _validate(self, entry):
+        now = time.monotonic()
+        if now - entry.created_at > self.max_lifetime:
+            self.recycled += 1
+            self._close(entry)
+            return self._connect()
+        if now - entry.last_used > self.health_check_interval:
+            try:
+                entry.conn.ping()
+            except MySQLdb.Error:
+                self.failed_health_checks += 1
+                self._close(entry)
+                return self._connect()
+        return entry
+
+    def release(self, entry, discard=False):
+        if not discard:
+            try:
+                # Never hand an open transaction to the next request
+                entry.conn.rollback()
+            except MySQLdb.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+            else:
+                entry.last_used = time.monotonic()
+                self._idle.append(entry)
+            self._cond.notify()
+
+        if discard:
+            self._close(entry)
+
+    def _close(self, entry):
+        try:
+            entry.conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for entry in idle:
+            self._close(entry)
+
+    def stats(self):
+        with self._cond:
+            size, idle, in_use = self._size, len(self._idle), self._in_use
+        return {
+            'size': size,
+            'idle': idle,
+            'in_use': in_use,
+            'max_size': self.max_size,
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'connects': self.connects,
+            'recycled': self.recycled,
+            'failed_health_checks': self.failed_health_checks,
+            'total_wait_seconds': self.total_wait_time,
+            'max_wait_seconds': self.max_wait_time,
+        }
+
+
+def replication_lag(conn):
+    """Seconds `conn`'s server is behind its source, or None if it isn't replicating."""
+    cur = conn.cursor()
+    try:
+        try:
+            cur.execute("SHOW REPLICA STATUS")
+        except MySQLdb.ProgrammingError:
+            # MySQL before 8.0.22, MariaDB before 10.5.1
+            cur.execute("SHOW SLAVE STATUS")
+        row = cur.fetchone()
+        if row is None:
+            return None
+        status = dict(zip([column[0] for column in cur.description], row))
+    finally:
+        cur.close()
+    # NULL while the replication threads are stopped
+    return status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+
+
+class _Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.lag = None
+        self.error = None
+        self.checked_at = float('-inf')
+        self.usable = True
+        self.reads = 0
+
+
+class ReplicaSet:
+    """Read replicas, each with its own ConnectionPool, and their replication lag.
+
+    A background thread measures every replica's lag each `check_interval`
+    seconds, so requests never wait on a slow or unreachable replica.
+    Replicas more than `max_lag` seconds behind, not replicating,
+    unreachable, or not checked lately are skipped.
+    """
+
+    def __init__(self, pools, max_lag=5, check_interval=5, logger=None):
+        self.replicas = [_Replica(name, pool) for name, pool in pools]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.logger = logger
+        self.fallbacks = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name="replica-lag", daemon=True)
+        self._thread.start()
+
+    def _monitor(self):
+        while not self._stop.is_set():
+            for replica in self.replicas:
+                self.check(replica)
+            self._stop.wait(self.check_interval)
+
+    def choose(self):
+        """Return a healthy replica at random, or None."""
+        healthy = [replica for replica in self.replicas if self.healthy(replica)]
+        if not healthy:
+            self.fallbacks += 1
+            return None
+        replica = random.choice(healthy)
+        replica.reads += 1
+        return replica
+
+    def healthy(self, replica):
+        # A measurement the monitor failed to renew says nothing about the lag now
+        fresh = time.monotonic() - replica.checked_at < 3 * self.check_interval
+        return fresh and replica.lag is not None and replica.lag <= self.max_lag
+
+    def check(self, replica):
+        try:
+            entry = replica.pool.acquire()
+        except (MySQLdb.Error, PoolTimeout) as e:
+            replica.lag, replica.error = None, e
+        else:
+            discard = False
+            try:
+                replica.lag, replica.error = replication_lag(entry.conn), None
+            except MySQLdb.Error as e:
+                replica.lag, replica.error = None, e
+                discard = isinstance(e, MySQLdb.OperationalError)
+            finally:
+                replica.pool.release(entry, discard=discard)
+        replica.checked_at = time.monotonic()
+
+        # Log changes only, not every check
+        usable = replica.lag is not None and replica.lag <= self.max_lag
+        if self.logger is not None and usable != replica.usable:
+            if usable:
+                self.logger.info("Read replica %s back in use (%ss behind)", replica.name, replica.lag)
+            else:
+                reason = replica.error or ("not replicating" if replica.lag is None else f"{replica.lag}s behind")
+                self.logger.warning("Read replica %s skipped: %s", replica.name, reason)
+        replica.usable = usable
+
+    def stats(self):
+        return [{
+            'replica': replica.name,
+            'lag_seconds': replica.lag,
+            'healthy': self.healthy(replica),
+            'reads': replica.reads,
+            **replica.pool.stats(),
+        } for replica in self.replicas]
+
+    def close(self):
+        self._stop.set()
+        for replica in self.replicas:
+            replica.pool.close()
+
+
+class PooledMySQL:
+    """Flask extension exposing a pooled connection as `mysql.connection`.
+
+    Reads the same MYSQL_* settings as flask_mysqldb, plus MYSQL_POOL_MIN_SIZE,
+    MYSQL_POOL_MAX_SIZE, MYSQL_POOL_MAX_LIFETIME, MYSQL_POOL_HEALTH_CHECK_INTERVAL
+    and MYSQL_POOL_CHECKOUT_TIMEOUT. `connection_class` replaces MySQLdb's
+    Connection, e.g. to instrument the cursors.
+
+    MYSQL_REPLICAS lists the read replicas as dicts of the MySQLdb.connect()
+    arguments (host, port, user, ...) that differ from the primary's.
+    MYSQL_REPLICA_MAX_LAG and MYSQL_REPLICA_LAG_CHECK_INTERVAL are in seconds.
+    """
+
+    # Session key holding the time of the session's last write
+    WRITE_KEY = '_db_written_at'
+
+    def __init__(self, app=None, connection_class=None):
+        self.app = None
+        self.connection_class = connection_class
+        self._pool = None
+        self._pool_pid = None
+        self._replicas = None
+        self._replicas_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('MYSQL_HOST', 'localhost')
+        app.config.setdefault('MYSQL_USER', None)
+        app.config.setdefault('MYSQL_PASSWORD', None)
+        app.config.setdefault('MYSQL_DB', None)
+        app.config.setdefault('MYSQL_PORT', 3306)
+        app.config.setdefault('MYSQL_UNIX_SOCKET', None)
+        app.config.setdefault('MYSQL_CONNECT_TIMEOUT', 10)
+        app.config.setdefault('MYSQL_CHARSET', 'utf8mb4')
+        app.config.setdefault('MYSQL_POOL_MIN_SIZE', 1)
+        app.config.setdefault('MYSQL_POOL_MAX_SIZE', 10)
+        app.config.setdefault('MYSQL_POOL_MAX_LIFETIME', 3600)
+        app.config.setdefault('MYSQL_POOL_HEALTH_CHECK_INTERVAL', 30)
+        app.config.setdefault('MYSQL_POOL_CHECKOUT_TIMEOUT', 5)
+        app.config.setdefault('MYSQL_REPLICAS', [])
+        app.config.setdefault('MYSQL_REPLICA_MAX_LAG', 5)
+        app.config.setdefault('MYSQL_REPLICA_LAG_CHECK_INTERVAL', 5)
+
+        app.after_request(self._note_write)
+        app.teardown_appcontext(self.teardown)
+        app.extensions['mysql'] = self
+
+    def _connect_args(self, replica=None):
+        config = self.app.config
+        args = {
+            'host': config['MYSQL_HOST'],
+            'port': config['MYSQL_PORT'],
+            'connect_timeout': config['MYSQL_CONNECT_TIMEOUT'],
+            'charset': config['MYSQL_CHARSET'],
+        }
+        if config['MYSQL_USER']:
+            args['user'] = config['MYSQL_USER']
+        if config['MYSQL_PASSWORD']:
+            args['password'] = config['MYSQL_PASSWORD']
+        if config['MYSQL_DB']:
+            args['database'] = config['MYSQL_DB']
+        if config['MYSQL_UNIX_SOCKET']:
+            args['unix_socket'] = config['MYSQL_UNIX_SOCKET']
+        if replica:
+            args.update(replica)
+        return args
+
+    def _new_pool(self, replica=None):
+        config = self.app.config
+        return ConnectionPool(
+            self._connect_args(replica),
+            min_size=config['MYSQL_POOL_MIN_SIZE'],
+            max_size=config['MYSQL_POOL_MAX_SIZE'],
+            max_lifetime=config['MYSQL_POOL_MAX_LIFETIME'],
+            health_check_interval=config['MYSQL_POOL_HEALTH_CHECK_INTERVAL'],
+            checkout_timeout=config['MYSQL_POOL_CHECKOUT_TIMEOUT'],
+            connect=self.connection_class or MySQLdb.connect,
+        )
+
+    @property
+    def pool(self):
+        # Built lazily and per process, so gunicorn workers never share
+        # sockets opened before the fork
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            with self._lock:
+                if self._pool is None or self._pool_pid != pid:
+                    self._pool = self._new_pool()
+                    self._pool_pid = pid
+                    try:
+                        self._pool.fill()
+                    except MySQLdb.Error:
+                        # Checkouts open connections on demand and surface the error
+                        pass
+        return self._pool
+
+    @property
+    def replicas(self):
+        """This process's ReplicaSet, or None without MYSQL_REPLICAS."""
+        config = self.app.config
+        if not config['MYSQL_REPLICAS']:
+            return None
+        pid = os.getpid()
+        if self._replicas is None or self._replicas_pid != pid:
+            with self._lock:
+                if self._replicas is None or self._replicas_pid != pid:
+                    pools = []
+                    for replica in config['MYSQL_REPLICAS']:
+                        args = self._connect_args(replica)
+                        pools.append((f"{args['host']}:{args['port']}", self._new_pool(replica)))
+                    self._replicas = ReplicaSet(pools, max_lag=config['MYSQL_REPLICA_MAX_LAG'],
+                                                check_interval=config['MYSQL_REPLICA_LAG_CHECK_INTERVAL'],
+                                                logger=self.app.logger)
+                    self._replicas.start()
+                    self._replicas_pid = pid
+        return self._replicas
+
+    @property
+    def stale_window(self):
+        """Seconds after a write during which a healthy replica may still miss it."""
+        config = self.app.config
+        return config['MYSQL_REPLICA_MAX_LAG'] + config['MYSQL_REPLICA_LAG_CHECK_INTERVAL']
+
+    def wrote_recently(self):
+        """True if the current session wrote within the last stale_window seconds."""
+        written_at = session.get(self.WRITE_KEY) if has_request_context() else None
+        return written_at is not None and time.time() - written_at < self.stale_window
+
+    @property
+    def connection(self):
+        entry = g.get('_mysql_entry')
+        if entry is None:
+            entry = self.pool.acquire()
+            g._mysql_entry = entry
+        return entry.conn
+
+    @property
+    def latest(self):
+        """Autocommit connection to the primary, for reads that must not be older than a stamp.
+
+        Every statement reads what was committed before it ran, whatever
+        snapshot `mysql.connection` holds. It is a checkout of its own, so
+        work pending on `mysql.connection` is neither seen nor discarded.
+        """
+        entry = g.get('_mysql_latest')
+        if entry is None:
+            entry = self.pool.acquire()
+            try:
+                entry.conn.autocommit(True)
+            except MySQLdb.Error:
+                self._pool.release(entry, discard=True)
+                raise
+            g._mysql_latest = entry
+        return entry.conn
+
+    @property
+    def reader(self):
+        """Connection for reads that may be a few seconds stale.
+
+        A replica's connection when one is healthy and the session hasn't
+        written recently, otherwise the primary's (`mysql.connection`).
+        """
+        checkout = g.get('_mysql_reader')
+        if checkout is None:
+            replicas = self.replicas
+            replica = replicas.choose() if replicas is not None and not self.wrote_recently() else None
+            if replica is None:
+                return self.connection
+            try:
+                checkout = (replica, replica.pool.acquire())
+            except (MySQLdb.Error, PoolTimeout):
+                # Found unhealthy at its next check; until then fall back
+                return self.connection
+            g._mysql_reader = checkout
+        return checkout[1].conn
+
+    def _note_write(self, response):
+        # Anything but a safe request that used the primary counts as a write
+        if (self.app.config['MYSQL_REPLICAS'] and '_mysql_entry' in g
+                and request.method not in ('GET', 'HEAD', 'OPTIONS')):
+            session[self.WRITE_KEY] = time.time()
+        return response
+
+    def teardown(self, exception):
+        # A connection that failed mid-request may be in an unknown state
+        discard = isinstance(exception, MySQLdb.OperationalError)
+        entry = g.pop('_mysql_entry', None)
+        if entry is not None:
+            self._pool.release(entry, discard=discard)
+        checkout = g.pop('_mysql_reader', None)
+        if checkout is not None:
+            replica, entry = checkout
+            replica.pool.release(entry, discard=discard)
+        entry = g.pop('_mysql_latest', None)
+        if entry is not None:
+            try:
+                # Back to the pool's transactional default
+                entry.conn.autocommit(False)
+                latest_discard = discard
+            except MySQLdb.Error:
+                latest_discard = True
+            self._pool.release(entry, discard=latest_discard)
@@ -0,0 +1,76 @@
+"""Streaming CSV/NDJSON exports for the admin tools.
+
+The counterpart of bulk_import: each export is a single query read from an
+unbuffered (server-side) cursor in chunks of rows, and every chunk is
+formatted and handed on before the next one is fetched. An export of any
+size therefore only ever holds one chunk in memory.
+"""
+import csv
+import io
+import json
+
+from MySQLdb.cursors import SSDictCursor
+
+# Password hashes are never exported
+EXPORTS = {
+    'loans': """
+        SELECT ub.user_id, u.username, u.email, ub.book_id, b.book_name, b.author, ub.quantity,
+               ub.borrowed_at, ub.due_at
+        FROM user_books ub
+        JOIN books b ON ub.book_id = b.id
+        JOIN users u ON ub.user_id = u.id
+        ORDER BY ub.user_id, ub.book_id
+    """,
+    'books': """
+        SELECT id, book_name, author, amount, on_loan, on_hold, waiting_holds, for_exchange
+        FROM books
+        ORDER BY id
+    """,
+    'users': """
+        SELECT id, username, email, first_name, second_name, dob, address, photo_filename, role, is_banned,
+               books_on_loan
+        FROM users
+        ORDER BY id
+    """,
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def export(conn, name, fmt='csv', chunk_rows=1000):
+    """Yield export `name` as text chunks in `fmt`, one chunk per `chunk_rows` rows.
+
+    CSV output starts with a header row, even when there are no rows.
+    """
+    cur = conn.cursor(cursorclass=SSDictCursor)
+    buffer = io.StringIO()
+
+    def take():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    try:
+        cur.execute(EXPORTS[name])
+        writer = None
+        if fmt == 'csv':
+            writer = csv.DictWriter(buffer, fieldnames=[column[0] for column in cur.description])
+            writer.writeheader()
+            yield take()
+
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                buffer.writelines(json.dumps(row, default=str) + "\n" for row in rows)
+            yield take()
+    finally:
+        # Closing an unbuffered cursor also drains rows the caller didn't read
+        cur.close()
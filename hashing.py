@@ -0,0 +1,188 @@
+"""Password hashing and verification off the request threads.
+
+generate_password_hash/check_password_hash are deliberately slow. Running
+them on a bounded process pool keeps a login spike from starving the rest
+of the app, and a full queue fails fast with HashingBusy instead of
+letting requests pile up behind it.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    """The hashing queue is full, or a job didn't finish in time."""
+
+
+def hash_passwords(passwords, method):
+    """Hash a chunk of passwords in one job (bulk imports)."""
+    return [generate_password_hash(password, method) for password in passwords]
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords on a pool of `workers` processes.
+
+    At most `max_pending` jobs may be queued or running; beyond that calls
+    raise HashingBusy straight away. With `workers=0` everything runs inline
+    on the calling thread (still counted in the metrics).
+    """
+
+    def __init__(self, workers=2, max_pending=None, timeout=10, method='scrypt'):
+        self.workers = workers
+        self.max_pending = max_pending or max(workers, 1) * 4
+        self.timeout = timeout
+        self.method = method
+
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._current_prefix = None
+
+        # Metrics
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.pools_broken = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def executor(self):
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    # Spawned, not forked: the parent holds sockets and threads
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                    self._executor_pid = pid
+        return self._executor
+
+    def _discard(self, executor):
+        """Drop a broken pool, so the next job starts a new one."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self.pools_broken += 1
+        executor.shutdown(wait=False)
+
+    def _finished(self, started):
+        latency = time.monotonic() - started
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        self._slots.release()
+
+    def _submit(self, function, args, wait=False):
+        """Queue a job and return its future. With `wait`, wait up to `timeout` for a free slot."""
+        acquired = self._slots.acquire(timeout=self.timeout) if wait else self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy("password hashing queue is full")
+
+        started = time.monotonic()
+        with self._lock:
+            self.pending += 1
+            self.submitted += 1
+
+        if not self.workers:
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._finished(started)
+            return future
+
+        try:
+            executor = self.executor
+            try:
+                future = executor.submit(function, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory): replace the pool once
+                self._discard(executor)
+                future = self.executor.submit(function, *args)
+        except Exception:
+            self._finished(started)
+            raise
+        # The slot is only freed once the job is really done, even if we stop waiting
+        future.add_done_callback(lambda _: self._finished(started))
+        return future
+
+    def _result(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            raise HashingBusy("password hashing timed out")
+        except BrokenProcessPool:
+            # Lost with its worker; the next job replaces the pool
+            raise HashingBusy("password hashing worker died")
+
+    def _run(self, function, *args):
+        return self._result(self._submit(function, args))
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def hash_many(self, passwords, chunk_size=16):
+        """Hash a batch of passwords, in order, for a bulk import.
+
+        Chunks of `chunk_size` passwords go through the same queue as the
+        logins, at most one per worker at a time. They wait for a free slot
+        instead of failing, and leave the rest of the queue to logins.
+        """
+        hashed = []
+        in_flight = deque()
+        for start in range(0, len(passwords), chunk_size):
+            if len(in_flight) >= max(self.workers, 1):
+                hashed.extend(self._result(in_flight.popleft()))
+            chunk = passwords[start:start + chunk_size]
+            in_flight.append(self._submit(hash_passwords, (chunk, self.method), wait=True))
+        while in_flight:
+            hashed.extend(self._result(in_flight.popleft()))
+        return hashed
+
+    def needs_rehash(self, pwhash):
+        """True if `pwhash` was made with other parameters than the current method's."""
+        if self._current_prefix is None:
+            # e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+            self._current_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._current_prefix
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'pools_broken': self.pools_broken,
+                'total_latency_seconds': self.total_latency,
+                'max_latency_seconds': self.max_latency,
+            }
+
+    def shutdown(self):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=True)
+        self._executor = None
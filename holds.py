@@ -0,0 +1,267 @@
+"""Hold queues (waitlists) for books with no copies on the shelf.
+
+A user who can't borrow a book because its copies are out joins the book's
+queue, a `waiting` row in book_holds. Copies coming back to the shelf are
+handed to the head of the queue in the same transaction: returns, an admin
+raising the amount, a hold expiring or being cancelled. The copies move from
+books.amount to books.on_hold and the hold becomes `ready` until its
+`expires_at`. The holder claims it by borrowing it. Unclaimed holds are
+expired by the sweeper and their copies go to the next in line.
+
+Holds are served strictly in queue (id) order, and nobody can borrow from the
+shelf while anyone is waiting (books.waiting_holds > 0). Nobody can jump the
+queue, and a busy title costs one queued row per reader instead of a
+stream of failed borrows.
+
+expire_holds() is run in the background by a periodic.PeriodicTask.
+
+The functions run in the caller's transaction and leave the commit to it,
+except expire_holds(). They take a DictCursor. The lock order is the same as
+for borrowing and returning: books, then book_holds, then user_books, then
+users.
+"""
+from MySQLdb import IntegrityError
+from MySQLdb.cursors import DictCursor
+
+# A user's holds, with their place in the queue. The position counts the
+# waiting holds up to this one on idx_book_holds_queue, reading only the index.
+USER_HOLDS = """
+    SELECT h.book_id, b.book_name, b.author, h.quantity, h.status, h.expires_at,
+           (SELECT COUNT(*) FROM book_holds q
+            WHERE q.book_id = h.book_id AND q.status = 'waiting' AND q.id <= h.id) AS position
+    FROM book_holds h
+    JOIN books b ON b.id = h.book_id
+    WHERE h.user_id = %s
+    ORDER BY h.id
+"""
+
+
+HOLD_POSITION = """
+    SELECT COUNT(*) AS position
+    FROM book_holds h
+    JOIN book_holds q ON q.book_id = h.book_id AND q.status = 'waiting' AND q.id <= h.id
+    WHERE h.user_id = %s AND h.book_id = %s AND h.status = 'waiting'
+"""
+
+HOLD_BOOK = """
+    SELECT book_name, amount, on_loan, on_hold, waiting_holds, for_exchange
+    FROM books WHERE id = %s FOR UPDATE
+"""
+
+QUEUE_HEAD = """
+    SELECT id, user_id, quantity FROM book_holds
+    WHERE book_id = %s AND status = 'waiting'
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE
+"""
+
+READY_HOLD = """
+    SELECT id, quantity FROM book_holds
+    WHERE user_id = %s AND book_id = %s AND status = 'ready' AND expires_at >= NOW()
+    FOR UPDATE
+"""
+
+USER_HOLD = "SELECT id, quantity, status FROM book_holds WHERE user_id = %s AND book_id = %s FOR UPDATE"
+
+USER_HOLD_BOOKS = "SELECT book_id FROM book_holds WHERE user_id = %s ORDER BY book_id"
+
+BOOK_HOLDS = "SELECT user_id FROM book_holds WHERE book_id = %s FOR UPDATE"
+
+EXPIRED_HOLD_BOOKS = """
+    SELECT DISTINCT book_id FROM book_holds
+    WHERE status = 'ready' AND expires_at < NOW()
+    LIMIT %s
+"""
+
+EXPIRED_HOLDS = """
+    SELECT id, user_id, quantity FROM book_holds
+    WHERE book_id = %s AND status = 'ready' AND expires_at < NOW()
+    FOR UPDATE
+"""
+
+
+def user_holds(cur, user_id):
+    cur.execute(USER_HOLDS, (user_id,))
+    return cur.fetchall()
+
+
+def hold_position(cur, user_id, book_id):
+    """Place in the queue of the user's waiting hold on a book, or None."""
+    cur.execute(HOLD_POSITION, (user_id, book_id))
+    row = cur.fetchone()
+    return row['position'] if row and row['position'] else None
+
+
+def place_hold(cur, user_id, book_id, quantity):
+    """Put the user in the book's queue for `quantity` copies.
+
+    Returns None on success, otherwise the message to flash.
+    """
+    # Locking the book first means no return can slip in between the
+    # stock check and the insert and leave the copies on the shelf
+    cur.execute(HOLD_BOOK, (book_id,))
+    book = cur.fetchone()
+    if not book:
+        return 'Book not found.'
+    if not book['for_exchange']:
+        return f"{book['book_name']} is not available for exchange."
+    if book['amount'] >= quantity and not book['waiting_holds']:
+        return f"{book['book_name']} is on the shelf, you can borrow it now."
+    copies = book['amount'] + book['on_loan'] + book['on_hold']
+    if quantity > copies:
+        return f"The library only has {copies} copies of {book['book_name']}."
+
+    try:
+        cur.execute("INSERT INTO book_holds (book_id, user_id, quantity) VALUES (%s, %s, %s)",
+                    (book_id, user_id, quantity))
+    except IntegrityError:
+        return f"You already have a hold on {book['book_name']}."
+    cur.execute("UPDATE books SET waiting_holds = waiting_holds + 1, version = version + 1 WHERE id = %s",
+                (book_id,))
+    return None
+
+
+def serve_holds(cur, book_id, pickup_hours):
+    """Hand the book's shelf copies to the head of its queue.
+
+    Holds are made ready in queue order for as long as the shelf has enough
+    copies for the next one. Returns the ids of the users served, whose
+    pages the caller refreshes with touch_users() once it is done with the
+    other tables.
+    """
+    cur.execute("SELECT amount, waiting_holds, for_exchange FROM books WHERE id = %s FOR UPDATE", (book_id,))
+    book = cur.fetchone()
+    if not book or not book['waiting_holds'] or not book['for_exchange'] or book['amount'] < 1:
+        return []
+
+    # Every hold wants at least one copy, so at most `amount` can be served
+    cur.execute(QUEUE_HEAD, (book_id, book['amount']))
+    served = []
+    copies = 0
+    for hold in cur.fetchall():
+        if copies + hold['quantity'] > book['amount']:
+            break
+        served.append(hold)
+        copies += hold['quantity']
+    if not served:
+        return []
+
+    placeholders = ", ".join(["%s"] * len(served))
+    cur.execute(f"""
+        UPDATE book_holds SET status = 'ready', expires_at = NOW() + INTERVAL %s HOUR
+        WHERE id IN ({placeholders})
+    """, [pickup_hours] + [hold['id'] for hold in served])
+    cur.execute("""
+        UPDATE books
+        SET amount = amount - %s, on_hold = on_hold + %s, waiting_holds = waiting_holds - %s,
+            version = version + 1
+        WHERE id = %s
+    """, (copies, copies, len(served), book_id))
+    return [hold['user_id'] for hold in served]
+
+
+def claim_hold(cur, user_id, book_id):
+    """Take the copies set aside for the user's ready hold out of on_hold.
+
+    Returns the number of copies, which the caller then lends, or None if
+    the user has no unexpired ready hold on the book.
+    """
+    cur.execute("SELECT id FROM books WHERE id = %s FOR UPDATE", (book_id,))
+    cur.execute(READY_HOLD, (user_id, book_id))
+    hold = cur.fetchone()
+    if not hold:
+        return None
+
+    cur.execute("DELETE FROM book_holds WHERE id = %s", (hold['id'],))
+    cur.execute("""
+        UPDATE books SET on_hold = on_hold - %s, on_loan = on_loan + %s, version = version + 1
+        WHERE id = %s
+    """, (hold['quantity'], hold['quantity'], book_id))
+    return hold['quantity']
+
+
+def cancel_hold(cur, user_id, book_id, pickup_hours):
+    """Drop the user's hold on a book, passing any copies set aside for it on.
+
+    Returns the ids of the users served from the queue as a result, or None
+    if the user had no hold on the book.
+    """
+    cur.execute("SELECT id FROM books WHERE id = %s FOR UPDATE", (book_id,))
+    cur.execute(USER_HOLD, (user_id, book_id))
+    hold = cur.fetchone()
+    if not hold:
+        return None
+
+    cur.execute("DELETE FROM book_holds WHERE id = %s", (hold['id'],))
+    if hold['status'] == 'ready':
+        cur.execute("""
+            UPDATE books SET on_hold = on_hold - %s, amount = amount + %s, version = version + 1
+            WHERE id = %s
+        """, (hold['quantity'], hold['quantity'], book_id))
+    else:
+        # The next hold may want fewer copies than the shelf has
+        cur.execute("UPDATE books SET waiting_holds = waiting_holds - 1, version = version + 1 WHERE id = %s",
+                    (book_id,))
+    return serve_holds(cur, book_id, pickup_hours)
+
+
+def cancel_user_holds(cur, user_id, pickup_hours):
+    """Drop all of a user's holds, e.g. before deleting the user. Returns the users served."""
+    cur.execute(USER_HOLD_BOOKS, (user_id,))
+    served = []
+    for row in cur.fetchall():
+        served.extend(cancel_hold(cur, user_id, row['book_id'], pickup_hours) or [])
+    return served
+
+
+def drop_book_holds(cur, book_id):
+    """Delete every hold on a book being deleted. Returns the users who held them."""
+    cur.execute(BOOK_HOLDS, (book_id,))
+    user_ids = [row['user_id'] for row in cur.fetchall()]
+    if user_ids:
+        cur.execute("DELETE FROM book_holds WHERE book_id = %s", (book_id,))
+    return user_ids
+
+
+def touch_users(cur, user_ids):
+    """Bump the loan page version of users whose holds changed."""
+    user_ids = sorted({int(user_id) for user_id in user_ids})
+    if user_ids:
+        placeholders = ", ".join(["%s"] * len(user_ids))
+        cur.execute(f"UPDATE users SET loans_version = loans_version + 1 WHERE id IN ({placeholders})", user_ids)
+
+
+def expire_holds(conn, pickup_hours, limit=500):
+    """Expire ready holds past their pickup time and hand their copies on.
+
+    Each book is its own transaction, so the sweep never holds more than one
+    book's locks. Returns the number of holds expired.
+    """
+    cur = conn.cursor(cursorclass=DictCursor)
+    expired = 0
+    try:
+        cur.execute(EXPIRED_HOLD_BOOKS, (limit,))
+        for book_id in [row['book_id'] for row in cur.fetchall()]:
+            cur.execute("SELECT id FROM books WHERE id = %s FOR UPDATE", (book_id,))
+            cur.execute(EXPIRED_HOLDS, (book_id,))
+            holds = cur.fetchall()
+            if holds:
+                placeholders = ", ".join(["%s"] * len(holds))
+                copies = sum(hold['quantity'] for hold in holds)
+                cur.execute(f"DELETE FROM book_holds WHERE id IN ({placeholders})", [hold['id'] for hold in holds])
+                cur.execute("""
+                    UPDATE books SET on_hold = on_hold - %s, amount = amount + %s, version = version + 1
+                    WHERE id = %s
+                """, (copies, copies, book_id))
+                served = serve_holds(cur, book_id, pickup_hours)
+                touch_users(cur, [hold['user_id'] for hold in holds] + served)
+            conn.commit()
+            expired += len(holds)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return expired
+
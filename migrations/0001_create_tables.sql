@@ -0,0 +1,29 @@
+-- The original tables of the library
+CREATE TABLE books (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    book_name VARCHAR(255),
+    author VARCHAR(255),
+    amount INT,
+    for_exchange TINYINT(1)
+) ENGINE=InnoDB;
+
+CREATE TABLE user_books (
+    user_id INT,
+    book_id INT,
+    quantity INT,
+    PRIMARY KEY (user_id, book_id)
+) ENGINE=InnoDB;
+
+CREATE TABLE users (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(50),
+    password VARCHAR(255),
+    email VARCHAR(100),
+    first_name VARCHAR(255),
+    second_name VARCHAR(255),
+    dob DATE,
+    address VARCHAR(255),
+    photo_filename VARCHAR(255),
+    role VARCHAR(20),
+    is_banned TINYINT(1)
+) ENGINE=InnoDB;
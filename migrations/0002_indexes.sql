@@ -0,0 +1,20 @@
+-- Title/author search (words of 3+ characters)
+CREATE FULLTEXT INDEX ft_books_name_author ON books (book_name, author);
+
+-- One row per title/author: addBook and the bulk import rely on it to detect
+-- duplicates (remove existing duplicates before migrating)
+CREATE UNIQUE INDEX uq_books_name_author ON books (book_name, author);
+
+-- Keyset pagination for the "title" and "author" sort orders
+CREATE INDEX idx_books_name ON books (book_name);
+CREATE INDEX idx_books_author ON books (author);
+
+-- Login, registration and the bulk user import look users up by email
+CREATE UNIQUE INDEX uq_users_email ON users (email);
+
+-- A stored photo is only deleted once no user refers to it
+CREATE INDEX idx_users_photo ON users (photo_filename);
+
+-- Holders of a book (view_book, delete_book, update_book). The primary key
+-- only serves lookups by user_id.
+CREATE INDEX idx_user_books_book ON user_books (book_id);
@@ -0,0 +1,4 @@
+-- Version stamps behind the ETags of the book, user and loan pages
+ALTER TABLE users ADD COLUMN version INT NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN loans_version INT NOT NULL DEFAULT 0;
+ALTER TABLE books ADD COLUMN version INT NOT NULL DEFAULT 0;
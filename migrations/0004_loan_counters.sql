@@ -0,0 +1,14 @@
+-- Copies each user holds and copies of each book out on loan, kept up to
+-- date by borrowing and returning. books.amount stays the copies on the
+-- shelf, so a book's total is amount + on_loan.
+ALTER TABLE users ADD COLUMN books_on_loan INT NOT NULL DEFAULT 0;
+ALTER TABLE books ADD COLUMN on_loan INT NOT NULL DEFAULT 0;
+
+-- Start from the current loans
+UPDATE users u
+JOIN (SELECT user_id, SUM(quantity) AS quantity FROM user_books GROUP BY user_id) loans ON loans.user_id = u.id
+SET u.books_on_loan = loans.quantity;
+
+UPDATE books b
+JOIN (SELECT book_id, SUM(quantity) AS quantity FROM user_books GROUP BY book_id) loans ON loans.book_id = b.id
+SET b.on_loan = loans.quantity;
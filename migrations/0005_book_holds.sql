@@ -0,0 +1,19 @@
+-- Waitlists for books with no copies on the shelf. Holds are served in id
+-- order. A ready hold has its copies set aside (books.on_hold) until it is
+-- claimed or expires, so a book's total is amount + on_loan + on_hold.
+-- books.waiting_holds counts the holds still waiting for copies.
+CREATE TABLE book_holds (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    book_id INT NOT NULL,
+    user_id INT NOT NULL,
+    quantity INT NOT NULL,
+    status ENUM('waiting', 'ready') NOT NULL DEFAULT 'waiting',
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at DATETIME NULL,
+    UNIQUE KEY uq_book_holds_user_book (user_id, book_id),
+    KEY idx_book_holds_queue (book_id, status, id),
+    KEY idx_book_holds_expiry (status, expires_at)
+) ENGINE=InnoDB;
+
+ALTER TABLE books ADD COLUMN on_hold INT NOT NULL DEFAULT 0;
+ALTER TABLE books ADD COLUMN waiting_holds INT NOT NULL DEFAULT 0;
@@ -0,0 +1,25 @@
+-- When each loan was taken out and when it is due. Borrowing more copies of
+-- a book already on loan keeps the loan's dates: the first copies are still
+-- due then. Loans from before this migration are due 14 days from now.
+ALTER TABLE user_books ADD COLUMN borrowed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE user_books ADD COLUMN due_at DATETIME NULL;
+UPDATE user_books SET due_at = borrowed_at + INTERVAL 14 DAY WHERE due_at IS NULL;
+CREATE INDEX idx_user_books_due ON user_books (due_at);
+
+-- Loans found overdue by the sweeper, for the admin overdue page. A row is
+-- deleted when its loan is returned in full.
+CREATE TABLE overdue_loans (
+    user_id INT NOT NULL,
+    book_id INT NOT NULL,
+    due_at DATETIME NOT NULL,
+    detected_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, book_id),
+    KEY idx_overdue_loans_due (due_at)
+) ENGINE=InnoDB;
+
+-- How far each incremental job has got, e.g. the due date up to which
+-- loans have been checked for being overdue
+CREATE TABLE job_watermarks (
+    name VARCHAR(64) PRIMARY KEY,
+    watermark DATETIME NOT NULL
+) ENGINE=InnoDB;
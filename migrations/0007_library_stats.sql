@@ -0,0 +1,26 @@
+-- Counters for the admin dashboard, updated by the routes that change them.
+-- Each counter is spread over several rows (shards) so that concurrent
+-- borrows don't all wait on one row; its value is the sum of its shards.
+CREATE TABLE library_stats (
+    name VARCHAR(40) NOT NULL,
+    shard TINYINT UNSIGNED NOT NULL,
+    value BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, shard)
+) ENGINE=InnoDB;
+
+-- Copies borrowed per book, for the most borrowed titles
+CREATE TABLE book_loan_stats (
+    book_id INT PRIMARY KEY,
+    loans BIGINT NOT NULL DEFAULT 0,
+    KEY idx_book_loan_stats_loans (loans)
+) ENGINE=InnoDB;
+
+-- Start from the current state (the same as `flask rebuild-stats`)
+INSERT IGNORE INTO library_stats (name, shard, value)
+SELECT 'copies', 0, COALESCE(SUM(amount + on_loan + on_hold), 0) FROM books
+UNION ALL SELECT 'copies_on_loan', 0, COALESCE(SUM(on_loan), 0) FROM books
+UNION ALL SELECT 'active_borrowers', 0, COUNT(*) FROM users WHERE books_on_loan > 0
+UNION ALL SELECT 'banned_users', 0, COUNT(*) FROM users WHERE is_banned;
+
+INSERT IGNORE INTO book_loan_stats (book_id, loans)
+SELECT book_id, SUM(quantity) FROM user_books GROUP BY book_id;
@@ -0,0 +1,13 @@
+-- Logged-in users are authenticated from claims in their session cookie.
+-- auth_version is bumped whenever a user's role or ban status changes, which
+-- makes the claims issued before the change invalid.
+ALTER TABLE users ADD COLUMN auth_version INT NOT NULL DEFAULT 0;
+
+-- The latest auth version of every user whose claims changed (-1 once the
+-- user is deleted), read incrementally by each worker by time of change
+CREATE TABLE auth_changes (
+    user_id INT PRIMARY KEY,
+    auth_version INT NOT NULL,
+    changed_at DATETIME(6) NOT NULL,
+    KEY idx_auth_changes_changed (changed_at)
+) ENGINE=InnoDB;
@@ -0,0 +1,4 @@
+-- Users created by the app were stored with is_banned NULL, which
+-- `NOT is_banned` never matches: make "not banned" an explicit 0
+UPDATE users SET is_banned = 0 WHERE is_banned IS NULL;
+ALTER TABLE users MODIFY is_banned TINYINT(1) NOT NULL DEFAULT 0;
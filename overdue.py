@@ -0,0 +1,156 @@
+"""Overdue loans, found incrementally by a background sweep.
+
+Every loan has a due date (user_books.due_at, indexed). The sweep keeps a
+watermark in job_watermarks: the due date up to which loans have already
+been checked. Each run only walks the loans that fell due since then, in
+batches along idx_user_books_due, and copies them into overdue_loans. The
+admin overdue page reads that table instead of scanning the loans. Returning
+a loan in full removes its overdue_loans row (see loan_returned()).
+
+Only one worker sweeps at a time (a MySQL named lock), and the watermark
+only moves once every batch is in, so a sweep that dies half-way is simply
+repeated by the next one.
+"""
+from MySQLdb.cursors import DictCursor
+
+import auth_claims
+import stats
+
+WATERMARK = 'overdue_loans'
+LOCK_NAME = 'library.overdue_sweep'
+MAX_ID = 2**31 - 1
+
+# Keyset condition on (due_at, user_id, book_id), spelled out as ranges the
+# optimizer can use: the secondary index on due_at carries the primary key
+AFTER_POSITION = """
+    ({t}due_at > %s OR ({t}due_at = %s AND {t}user_id > %s)
+     OR ({t}due_at = %s AND {t}user_id = %s AND {t}book_id > %s))
+"""
+
+# Newly overdue loans, read from the index alone
+OVERDUE_BATCH = f"""
+    SELECT due_at, user_id, book_id FROM user_books
+    WHERE due_at <= %s AND {AFTER_POSITION.format(t='')}
+    ORDER BY due_at, user_id, book_id
+    LIMIT %s
+"""
+
+# The overdue page, oldest first
+OVERDUE_PAGE = f"""
+    SELECT o.user_id, u.username, u.is_banned, o.book_id, b.book_name, b.author,
+           ub.quantity, ub.borrowed_at, o.due_at
+    FROM overdue_loans o
+    JOIN user_books ub ON ub.user_id = o.user_id AND ub.book_id = o.book_id
+    JOIN users u ON u.id = o.user_id
+    JOIN books b ON b.id = o.book_id
+    WHERE {AFTER_POSITION.format(t='o.')}
+    ORDER BY o.due_at, o.user_id, o.book_id
+    LIMIT %s
+"""
+
+READ_WATERMARK = "SELECT watermark FROM job_watermarks WHERE name = %s"
+
+# Taken from user_books itself (and under its locks), so a loan returned
+# since the batch was read is left out. {placeholders} is one (%s, %s) per loan.
+RECORD_OVERDUE = """
+    INSERT IGNORE INTO overdue_loans (user_id, book_id, due_at)
+    SELECT user_id, book_id, due_at FROM user_books
+    WHERE (user_id, book_id) IN ({placeholders})
+"""
+
+CLEAR_OVERDUE = "DELETE FROM overdue_loans WHERE user_id = %s AND book_id = %s"
+
+# Borrowers still to ban, NULL is_banned meaning not banned. {placeholders} is one %s per user.
+BAN_CANDIDATES = """
+    SELECT id FROM users
+    WHERE id IN ({placeholders}) AND NOT COALESCE(is_banned, FALSE)
+        AND EXISTS (SELECT 1 FROM overdue_loans o WHERE o.user_id = users.id)
+    FOR UPDATE
+"""
+
+
+def position_params(due_at, user_id, book_id):
+    return (due_at, due_at, user_id, due_at, user_id, book_id)
+
+
+def loan_returned(cur, user_id, book_id):
+    """Forget a loan's overdue status once it has been returned in full."""
+    cur.execute(CLEAR_OVERDUE, (user_id, book_id))
+
+
+def overdue_page(cur, after=None, limit=100):
+    """One page of overdue loans after the position `after` ([due_at, user_id, book_id])."""
+    cur.execute(OVERDUE_PAGE, position_params(*(after or ('1000-01-01', 0, 0))) + (limit,))
+    return cur.fetchall()
+
+
+def sweep(conn, batch_size=500, auto_ban=False):
+    """Record the loans that fell due since the last sweep.
+
+    With `auto_ban`, their borrowers are banned as well. Returns (number of
+    loans found overdue, ids of the users banned), or (0, []) if another
+    worker is already sweeping.
+    """
+    cur = conn.cursor(cursorclass=DictCursor)
+    found = 0
+    banned = []
+    try:
+        cur.execute("SELECT GET_LOCK(%s, 0) AS locked", (LOCK_NAME,))
+        if not cur.fetchone()['locked']:
+            return 0, []
+        try:
+            cur.execute(READ_WATERMARK, (WATERMARK,))
+            row = cur.fetchone()
+            since = row['watermark'] if row else '1000-01-01'
+            cur.execute("SELECT NOW() AS now")
+            until = cur.fetchone()['now']
+            conn.commit()
+
+            # Past every loan due exactly at the watermark: the last sweep saw those
+            position = (since, MAX_ID, MAX_ID)
+            while True:
+                cur.execute(OVERDUE_BATCH, (until,) + position_params(*position) + (batch_size,))
+                loans = cur.fetchall()
+                if not loans:
+                    break
+                keys = [(loan['user_id'], loan['book_id']) for loan in loans]
+                placeholders = ", ".join(["(%s, %s)"] * len(keys))
+                params = [value for key in keys for value in key]
+                cur.execute(RECORD_OVERDUE.format(placeholders=placeholders), params)
+                found += cur.rowcount
+                if auto_ban:
+                    banned.extend(ban_borrowers(cur, sorted({user_id for user_id, _ in keys})))
+                conn.commit()
+                last = loans[-1]
+                position = (last['due_at'], last['user_id'], last['book_id'])
+
+            cur.execute("""
+                INSERT INTO job_watermarks (name, watermark) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE watermark = VALUES(watermark)
+            """, (WATERMARK, until))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("DO RELEASE_LOCK(%s)", (LOCK_NAME,))
+    finally:
+        cur.close()
+    return found, banned
+
+
+def ban_borrowers(cur, user_ids):
+    """Ban the users with overdue loans who aren't banned yet. Returns the ids of those banned.
+
+    is_banned may still be NULL (not banned) on databases without migration 0009.
+    """
+    placeholders = ", ".join(["%s"] * len(user_ids))
+    cur.execute(BAN_CANDIDATES.format(placeholders=placeholders), user_ids)
+    newly_banned = [row['id'] for row in cur.fetchall()]
+    if newly_banned:
+        placeholders = ", ".join(["%s"] * len(newly_banned))
+        cur.execute(f"UPDATE users SET is_banned = TRUE, version = version + 1 WHERE id IN ({placeholders})",
+                    newly_banned)
+        auth_claims.auth_changed(cur, newly_banned)
+        stats.record(cur, {stats.BANNED: len(newly_banned)})
+    return newly_banned
@@ -0,0 +1,37 @@
+"""Background jobs run every few seconds by each worker process."""
+import os
+import threading
+
+
+class PeriodicTask:
+    """Calls `run()` every `interval` seconds on a background thread.
+
+    Started lazily and per process, like the thumbnail pool, so every
+    gunicorn worker runs it. The jobs must be safe to run concurrently from
+    several workers. An interval of 0 or less disables the task.
+    """
+
+    def __init__(self, name, run, interval, logger=None):
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self.logger = logger
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._loop, name=self.name, daemon=True).start()
+                self._pid = os.getpid()
+
+    def _loop(self):
+        stop = threading.Event()
+        while not stop.wait(self.interval):
+            try:
+                self.run()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception("%s failed", self.name)
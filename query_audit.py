@@ -0,0 +1,84 @@
+"""EXPLAIN audit of the queries the routes issue.
+
+The routes and the modules they call keep their SQL in named constants, and
+the audit runs those same constants, so it can't drift from what is served.
+QUERIES lists the module queries with sample parameters; the app adds its
+own route queries (ROUTE_QUERIES in app.py), and captures the queries built
+at runtime (catalog search, user list pages) by running their builders
+against a RecordingCursor. Every query is EXPLAINed against the configured
+database, and a plan that reads a whole table with no usable index is
+reported, so a dropped index or an unindexed new query is caught before
+deploy. Add the constant of every new query to one of the lists.
+"""
+import auth_claims
+import bulk_import
+import holds
+import overdue
+import stats
+
+# (label, sql, sample parameters, full scan expected)
+QUERIES = [
+    ("holds: user's holds", holds.USER_HOLDS, (1,), False),
+    ("holds: position", holds.HOLD_POSITION, (1, 1), False),
+    ("holds: place hold", holds.HOLD_BOOK, (1,), False),
+    ("holds: head of queue", holds.QUEUE_HEAD, (1, 1), False),
+    ("holds: claim ready hold", holds.READY_HOLD, (1, 1), False),
+    ("holds: user's hold", holds.USER_HOLD, (1, 1), False),
+    ("holds: user's held books", holds.USER_HOLD_BOOKS, (1,), False),
+    ("holds: book's holds", holds.BOOK_HOLDS, (1,), False),
+    ("holds: expired books", holds.EXPIRED_HOLD_BOOKS, (500,), False),
+    ("holds: expired holds", holds.EXPIRED_HOLDS, (1,), False),
+    ("return: clear overdue", overdue.CLEAR_OVERDUE, (1, 1), False),
+    ("overdue sweep: watermark", overdue.READ_WATERMARK, (overdue.WATERMARK,), False),
+    ("overdue sweep: newly overdue", overdue.OVERDUE_BATCH,
+     ('2024-01-01',) + overdue.position_params('2023-12-01', 1, 1) + (500,), False),
+    ("overdue sweep: record", overdue.RECORD_OVERDUE.format(placeholders="(%s, %s)"), (1, 1), False),
+    ("overdue sweep: ban candidates", overdue.BAN_CANDIDATES.format(placeholders="%s, %s"), (1, 2), False),
+    ("overdue page", overdue.OVERDUE_PAGE, overdue.position_params('2023-12-01', 1, 1) + (100,), False),
+    ("stats: counters", stats.COUNTER_VALUES.format(placeholders="%s, %s"), (stats.COPIES, stats.ON_LOAN), False),
+    ("stats: top titles", stats.TOP_TITLES, (10,), False),
+    ("stats: loan counter", stats.LOAN_COUNTER, (1,), False),
+    ("auth versions: all changes", auth_claims.ALL_CHANGES, (), True),
+    ("auth versions: recent changes", auth_claims.RECENT_CHANGES, ('2024-01-01', 60), False),
+    ("import users: taken emails", bulk_import.TAKEN_EMAILS.format(placeholders="%s, %s"),
+     ('audit@example.com', 'audit2@example.com'), False),
+]
+
+
+class RecordingCursor:
+    """Stand-in cursor that records the queries a builder executes and returns no rows."""
+
+    def __init__(self):
+        self.queries = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        self.queries.append((sql, tuple(params)))
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return ()
+
+    def close(self):
+        pass
+
+
+def full_scans(plan):
+    """Return the plan rows reading a whole table without any usable index."""
+    return [row for row in plan
+            if row.get('type') == 'ALL' and not row.get('possible_keys') and row.get('table')]
+
+
+def audit(conn, queries):
+    """EXPLAIN every (label, sql, params, scan_expected) and yield (label, plan, scans, scan_expected)."""
+    cur = conn.cursor()
+    try:
+        for label, sql, params, scan_expected in queries:
+            cur.execute("EXPLAIN " + sql, params)
+            columns = [column[0] for column in cur.description]
+            plan = [dict(zip(columns, row)) for row in cur.fetchall()]
+            yield label, plan, full_scans(plan), scan_expected
+    finally:
+        cur.close()
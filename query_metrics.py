@@ -0,0 +1,207 @@
+"""Per-request SQL instrumentation.
+
+Connections of the pool are InstrumentedConnection objects, whose cursors
+time every execute()/executemany() and report it to QueryMetrics. For each
+request QueryMetrics counts the statements and the time spent in MySQL,
+adds them to the response as a Server-Timing header, logs statements slower
+than SLOW_QUERY_MS, and warns when one statement runs N_PLUS_ONE_THRESHOLD
+times or more (a query inside a loop). Totals per endpoint are kept in this
+process and rendered in the Prometheus text format.
+
+Only the execute call is timed; rows read later from an unbuffered cursor
+(the streamed exports and API collections) are not.
+"""
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from MySQLdb.connections import Connection
+
+# Upper bounds, in seconds, of the per-statement latency histogram
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class InstrumentedCursorMixin:
+    _timing = False
+
+    def execute(self, query, args=None):
+        return self._timed(super().execute, query, args)
+
+    def executemany(self, query, args):
+        return self._timed(super().executemany, query, args)
+
+    def _timed(self, method, query, args):
+        if self._timing:
+            # executemany() runs some statements through execute(); count the batch once
+            return method(query, args)
+        self._timing = True
+        started = time.perf_counter()
+        try:
+            return method(query, args)
+        finally:
+            self._timing = False
+            elapsed = time.perf_counter() - started
+            if has_request_context():
+                metrics = current_app.extensions.get('query_metrics')
+                if metrics is not None:
+                    metrics.record(query, elapsed)
+
+
+_instrumented_classes = {}
+
+
+def instrumented(cursorclass):
+    """Return the instrumented subclass of a MySQLdb cursor class."""
+    cls = _instrumented_classes.get(cursorclass)
+    if cls is None:
+        cls = type(f"Instrumented{cursorclass.__name__}", (InstrumentedCursorMixin, cursorclass), {})
+        _instrumented_classes[cursorclass] = cls
+    return cls
+
+
+class InstrumentedConnection(Connection):
+    """MySQLdb connection whose cursors, of any class, are instrumented."""
+
+    def cursor(self, cursorclass=None):
+        return instrumented(cursorclass or self.cursorclass)(self)
+
+
+def statement_text(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return " ".join(query.split())
+
+
+class _RequestQueries:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+
+class _EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.max_queries_per_request = 0
+        self.slow_queries = 0
+        self.n_plus_one = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class QueryMetrics:
+    """Flask extension collecting the SQL statements of every request."""
+
+    def __init__(self, app=None):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_MS', 200)
+        app.config.setdefault('N_PLUS_ONE_THRESHOLD', 10)
+        app.config.setdefault('SERVER_TIMING', True)
+
+        self.logger = app.logger
+        app.after_request(self._finish_request)
+        app.extensions['query_metrics'] = self
+
+    def _endpoint(self, endpoint):
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = _EndpointStats()
+        return stats
+
+    def record(self, query, seconds):
+        endpoint = request.endpoint or 'unknown'
+        current = g.get('_request_queries')
+        if current is None:
+            current = g._request_queries = _RequestQueries()
+        current.count += 1
+        current.seconds += seconds
+        statement = statement_text(query)
+        current.statements[statement] += 1
+
+        slow = seconds * 1000 >= current_app.config['SLOW_QUERY_MS']
+        with self._lock:
+            stats = self._endpoint(endpoint)
+            stats.observe(seconds)
+            stats.slow_queries += slow
+        if slow:
+            self.logger.warning("Slow query (%.1f ms) in %s: %s", seconds * 1000, endpoint, statement[:500])
+
+    def _finish_request(self, response):
+        endpoint = request.endpoint or 'unknown'
+        current = g.get('_request_queries') or _RequestQueries()
+
+        threshold = current_app.config['N_PLUS_ONE_THRESHOLD']
+        repeated = [(statement, count) for statement, count in current.statements.items() if count >= threshold]
+        for statement, count in repeated:
+            self.logger.warning("Possible N+1 in %s: statement ran %d times: %s", endpoint, count, statement[:500])
+
+        with self._lock:
+            stats = self._endpoint(endpoint)
+            stats.requests += 1
+            stats.max_queries_per_request = max(stats.max_queries_per_request, current.count)
+            stats.n_plus_one += bool(repeated)
+
+        if current_app.config['SERVER_TIMING']:
+            response.headers.add('Server-Timing',
+                                 f'db;dur={current.seconds * 1000:.2f};desc="{current.count} queries"')
+        return response
+
+    def prometheus(self):
+        """Render the per-endpoint totals in the Prometheus text format."""
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = []
+
+            def family(name, kind, description, samples):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(samples)
+
+            family('library_requests_total', 'counter', 'Requests served, by endpoint.',
+                   [f'library_requests_total{{endpoint="{e}"}} {s.requests}' for e, s in endpoints])
+            family('library_db_queries_total', 'counter', 'SQL statements executed, by endpoint.',
+                   [f'library_db_queries_total{{endpoint="{e}"}} {s.queries}' for e, s in endpoints])
+            family('library_db_max_queries_per_request', 'gauge', 'Most statements run by a single request.',
+                   [f'library_db_max_queries_per_request{{endpoint="{e}"}} {s.max_queries_per_request}'
+                    for e, s in endpoints])
+            family('library_db_slow_queries_total', 'counter', 'Statements slower than SLOW_QUERY_MS.',
+                   [f'library_db_slow_queries_total{{endpoint="{e}"}} {s.slow_queries}' for e, s in endpoints])
+            family('library_db_n_plus_one_total', 'counter', 'Requests that repeated one statement too often.',
+                   [f'library_db_n_plus_one_total{{endpoint="{e}"}} {s.n_plus_one}' for e, s in endpoints])
+
+            samples = []
+            for e, s in endpoints:
+                for bound, count in zip(LATENCY_BUCKETS, s.buckets):
+                    samples.append(f'library_db_statement_seconds_bucket{{endpoint="{e}",le="{bound}"}} {count}')
+                samples.append(f'library_db_statement_seconds_bucket{{endpoint="{e}",le="+Inf"}} {s.queries}')
+                samples.append(f'library_db_statement_seconds_sum{{endpoint="{e}"}} {s.seconds}')
+                samples.append(f'library_db_statement_seconds_count{{endpoint="{e}"}} {s.queries}')
+            family('library_db_statement_seconds', 'histogram', 'Latency of SQL statements, by endpoint.', samples)
+
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_gauges(prefix, stats):
+    """Render the numeric values of a stats() dict as Prometheus gauges."""
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = f"{prefix}_{key}"
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,183 @@
+"""Token-bucket rate limiting for the expensive POST routes.
+
+A limit like "10/minute" is a bucket of 10 tokens refilled at 10 per
+minute: bursts of up to 10 requests pass, and a steady client gets one
+request every 6 seconds. Each (limit, key) pair has its own bucket, where
+the key is a client address, an email or a user id.
+
+Buckets are checked before the route does any work, so a request over the
+limit costs a dictionary lookup (LocalBuckets) or one locked read and write
+of a shared memory-mapped file (FileBuckets), never a query or a password
+hash.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class RateLimited(Exception):
+    """A request went over a rate limit; retry after `retry_after` seconds."""
+
+    def __init__(self, limit, retry_after):
+        super().__init__(f"{limit} rate limit exceeded")
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+def parse_limit(spec):
+    """'10/minute' (or '10/5minute') -> (capacity, seconds to refill it)."""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*", spec or '')
+    if not match:
+        raise ValueError(f"invalid rate limit {spec!r}, expected e.g. '10/minute'")
+    return int(match.group(1)), int(match.group(2) or 1) * PERIODS[match.group(3)]
+
+
+def take(tokens, updated, now, capacity, period):
+    """Refill a bucket and take a token from it.
+
+    Returns (tokens, seconds to wait), where the wait is 0 if the token was
+    taken and the bucket is left unchanged otherwise.
+    """
+    rate = capacity / period
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class LocalBuckets:
+    """Buckets of this process only, the least recently used dropped past `maxsize`."""
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens, wait = take(tokens, updated, now, capacity, period)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class FileBuckets:
+    """Buckets shared by every process on the host, in a memory-mapped file.
+
+    The file is a table of `slots` fixed-size records (key hash, tokens,
+    last update, time the bucket is full again). Keys are hashed with
+    `secret`, so clients can't pick keys that collide. A key may live in any
+    of PROBES slots starting where its hash points. A new key takes a free
+    one among them: an empty slot, or one whose bucket has refilled, which
+    is as good as forgotten. If none is free, the request is refused until
+    one frees up. Taking over a busy slot would hand its bucket out full.
+    Each update locks only the bytes of those slots, so processes only wait
+    for each other on the same slots.
+    """
+
+    RECORD = struct.Struct('<Qddd')
+    HEADER = b'library-rate-limits-v2'
+    PROBES = 4
+
+    def __init__(self, path, slots=65536, secret=None):
+        self.path = path
+        self.slots = slots
+        self.secret = hashlib.blake2b((secret or '').encode(), digest_size=32).digest()
+        self._base = self.RECORD.size  # The first record holds the header
+        size = self._base + slots * self.RECORD.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size or os.pread(self._fd, len(self.HEADER), 0) != self.HEADER:
+                # New, or written by another version or table size: start over
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self.HEADER, 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        # Record locks are per process: threads of one process take turns here first
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8, key=self.secret).digest(),
+                                'little') or 1
+        first = digest % (self.slots - self.PROBES + 1)
+        start = self._base + first * self.RECORD.size
+        length = self.PROBES * self.RECORD.size
+        # Wall clock: monotonic clocks aren't comparable between processes
+        now = time.time()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                offsets = [start + probe * self.RECORD.size for probe in range(self.PROBES)]
+                records = [self.RECORD.unpack_from(self._map, offset) for offset in offsets]
+                found = free = None
+                for offset, (owner, tokens, updated, full_at) in zip(offsets, records):
+                    if owner == digest:
+                        found = offset, tokens, updated
+                        break
+                    if free is None and (not owner or full_at <= now):
+                        free = offset
+                if found is None:
+                    if free is None:
+                        # Every candidate slot belongs to a key still being limited
+                        return max(min(record[3] for record in records) - now, 1 / (capacity / period))
+                    found = free, capacity, now
+                offset, tokens, updated = found
+                if updated > now:
+                    updated = now
+                tokens, wait = take(tokens, updated, now, capacity, period)
+                full_at = now + (capacity - tokens) * period / capacity
+                self.RECORD.pack_into(self._map, offset, digest, tokens, now, full_at)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+        return wait
+
+
+class RateLimiter:
+    """Named limits ({name: '10/minute'}) checked against a bucket store."""
+
+    def __init__(self, buckets, limits, enabled=True):
+        self.buckets = buckets
+        self.limits = {name: parse_limit(spec) for name, spec in limits.items()}
+        self.enabled = enabled
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.allowed = dict.fromkeys(self.limits, 0)
+        self.rejected = dict.fromkeys(self.limits, 0)
+
+    def hit(self, name, key):
+        """Count a request against limit `name` for `key`; raise RateLimited if it is over."""
+        if not self.enabled or not key:
+            return
+        capacity, period = self.limits[name]
+        wait = self.buckets.take(f"{name}:{key}", capacity, period)
+        with self._lock:
+            if wait:
+                self.rejected[name] += 1
+            else:
+                self.allowed[name] += 1
+        if wait:
+            raise RateLimited(name, math.ceil(wait))
+
+    def stats(self):
+        with self._lock:
+            stats = {'enabled': int(self.enabled)}
+            for name in self.limits:
+                stats[f'{name}_allowed'] = self.allowed[name]
+                stats[f'{name}_rejected'] = self.rejected[name]
+            return stats
@@ -0,0 +1,152 @@
+"""Versioned schema migrations and checks of the indexes the queries rely on.
+
+Migrations are the numbered SQL files in migrations/ (`0001_name.sql`, ...).
+They are applied in order and recorded in the schema_migrations table.
+MySQL commits every DDL statement on its own, so a file that fails half-way
+can't be rolled back. Instead, a statement creating a table, column or index
+that already exists is skipped. Running the migrations again after fixing
+the problem, or against a database created by hand from the old README SQL,
+picks up where it stopped.
+"""
+import os
+import re
+
+import MySQLdb
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# MySQL error codes meaning the object a statement creates is already there
+ALREADY_EXISTS = {
+    1050,  # ER_TABLE_EXISTS_ERROR
+    1060,  # ER_DUP_FIELDNAME
+    1061,  # ER_DUP_KEYNAME
+    1068,  # ER_MULTIPLE_PRI_KEY
+}
+
+# Indexes the routes depend on: (table, name) -> (columns, unique, index type).
+# An index with another name but the same definition is accepted too.
+REQUIRED_INDEXES = {
+    ('users', 'PRIMARY'): (('id',), True, 'BTREE'),
+    ('users', 'uq_users_email'): (('email',), True, 'BTREE'),
+    ('users', 'idx_users_photo'): (('photo_filename',), False, 'BTREE'),
+    ('books', 'PRIMARY'): (('id',), True, 'BTREE'),
+    ('books', 'uq_books_name_author'): (('book_name', 'author'), True, 'BTREE'),
+    ('books', 'ft_books_name_author'): (('book_name', 'author'), False, 'FULLTEXT'),
+    ('books', 'idx_books_name'): (('book_name',), False, 'BTREE'),
+    ('books', 'idx_books_author'): (('author',), False, 'BTREE'),
+    ('user_books', 'PRIMARY'): (('user_id', 'book_id'), True, 'BTREE'),
+    ('user_books', 'idx_user_books_book'): (('book_id',), False, 'BTREE'),
+    ('user_books', 'idx_user_books_due'): (('due_at',), False, 'BTREE'),
+    ('overdue_loans', 'PRIMARY'): (('user_id', 'book_id'), True, 'BTREE'),
+    ('overdue_loans', 'idx_overdue_loans_due'): (('due_at',), False, 'BTREE'),
+    ('library_stats', 'PRIMARY'): (('name', 'shard'), True, 'BTREE'),
+    ('book_loan_stats', 'PRIMARY'): (('book_id',), True, 'BTREE'),
+    ('book_loan_stats', 'idx_book_loan_stats_loans'): (('loans',), False, 'BTREE'),
+    ('auth_changes', 'PRIMARY'): (('user_id',), True, 'BTREE'),
+    ('auth_changes', 'idx_auth_changes_changed'): (('changed_at',), False, 'BTREE'),
+    ('book_holds', 'PRIMARY'): (('id',), True, 'BTREE'),
+    ('book_holds', 'uq_book_holds_user_book'): (('user_id', 'book_id'), True, 'BTREE'),
+    ('book_holds', 'idx_book_holds_queue'): (('book_id', 'status', 'id'), False, 'BTREE'),
+    ('book_holds', 'idx_book_holds_expiry'): (('status', 'expires_at'), False, 'BTREE'),
+}
+
+
+class MigrationError(Exception):
+    """A migration statement failed."""
+
+
+def split_statements(sql):
+    """Split a migration file into statements, dropping `--` comment lines."""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in "\n".join(lines).split(';') if statement.strip()]
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Return [(version, name, statements)] for every migration file, in order."""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename), encoding='utf-8') as f:
+            migrations.append((int(match.group(1)), match.group(2), split_statements(f.read())))
+    migrations.sort()
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise MigrationError("two migration files share a version number")
+    return migrations
+
+
+def applied_migrations(conn):
+    """Return {version: applied_at} of the migrations already applied."""
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB
+    """)
+    cur.execute("SELECT version, applied_at FROM schema_migrations")
+    applied = dict(cur.fetchall())
+    cur.close()
+    return applied
+
+
+def migrate(conn, target=None, directory=MIGRATIONS_DIR):
+    """Apply pending migrations up to `target` (all by default).
+
+    Yields (version, name, skipped) after each migration is recorded, where
+    `skipped` counts its statements whose objects already existed.
+    """
+    applied = applied_migrations(conn)
+    cur = conn.cursor()
+    try:
+        for version, name, statements in load_migrations(directory):
+            if version in applied or (target is not None and version > target):
+                continue
+
+            skipped = 0
+            for statement in statements:
+                try:
+                    cur.execute(statement)
+                except (MySQLdb.OperationalError, MySQLdb.ProgrammingError) as e:
+                    if e.args[0] not in ALREADY_EXISTS:
+                        raise MigrationError(f"{version:04d}_{name}: {e.args[-1]}\n{statement}") from e
+                    skipped += 1
+
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+            yield version, name, skipped
+    finally:
+        cur.close()
+
+
+def check_indexes(conn):
+    """Return a message for every required index that is missing."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, INDEX_TYPE, COLUMN_NAME
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE()
+        ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+    """)
+    existing = {}
+    for table, index, non_unique, index_type, column in cur.fetchall():
+        columns, _, _ = existing.setdefault((table, index), ([], not non_unique, index_type))
+        columns.append(column)
+    cur.close()
+
+    definitions = {(table, tuple(columns), unique, index_type)
+                   for (table, _), (columns, unique, index_type) in existing.items()}
+    problems = []
+    for (table, index), (columns, unique, index_type) in REQUIRED_INDEXES.items():
+        found = (table, columns, True, index_type) in definitions
+        if not unique:
+            found = found or (table, columns, False, index_type) in definitions
+        if not found:
+            kind = 'unique ' if unique else ('full-text ' if index_type == 'FULLTEXT' else '')
+            problems.append(f"missing {kind}index {index} on {table} ({', '.join(columns)})")
+    return problems
@@ -0,0 +1,134 @@
+"""Library statistics for the admin dashboard, kept up to date incrementally.
+
+The routes that change a statistic add their delta to it in the same
+transaction (borrowing, returning, banning, adding or removing copies), so
+the dashboard never aggregates the big tables:
+
+- library_stats holds named counters: the copies the library owns, the
+  copies on loan, the borrowers with at least one loan, the banned users
+  and the copies borrowed each day (`loans_on:YYYY-MM-DD`). Every counter
+  is split over STATS_SHARDS rows and a transaction adds to a random one,
+  so concurrent borrows don't queue on a single hot row. A counter's value
+  is the sum of its shards, a few primary-key reads.
+- book_loan_stats counts the copies borrowed per book, for the top titles.
+
+record() must be the last write of a transaction: taking the stats rows
+after books, user_books and users keeps the lock order of the loan routes.
+`flask rebuild-stats` recomputes everything but the daily counts from the
+tables.
+"""
+import random
+from datetime import date, timedelta
+
+COPIES = 'copies'
+ON_LOAN = 'copies_on_loan'
+BORROWERS = 'active_borrowers'
+BANNED = 'banned_users'
+LOANS_ON = 'loans_on:'
+
+STATS_SHARDS = 16
+
+# {placeholders} is one %s per counter name
+COUNTER_VALUES = """
+    SELECT name, SUM(value) AS value FROM library_stats
+    WHERE name IN ({placeholders})
+    GROUP BY name
+"""
+
+TOP_TITLES = """
+    SELECT s.book_id, b.book_name, b.author, s.loans
+    FROM book_loan_stats s
+    JOIN books b ON b.id = s.book_id
+    ORDER BY s.loans DESC
+    LIMIT %s
+"""
+
+LOAN_COUNTER = "SELECT books_on_loan FROM users WHERE id = %s"
+
+
+def loans_on(day):
+    return LOANS_ON + day.isoformat()
+
+
+def record(cur, deltas, book_loans=None):
+    """Add `deltas` ({counter: delta}) and `book_loans` ({book_id: copies borrowed})."""
+    shard = random.randrange(STATS_SHARDS)
+    rows = [(name, shard, delta) for name, delta in sorted(deltas.items()) if delta]
+    if rows:
+        cur.executemany("""
+            INSERT INTO library_stats (name, shard, value) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE value = value + VALUES(value)
+        """, rows)
+    if book_loans:
+        cur.executemany("""
+            INSERT INTO book_loan_stats (book_id, loans) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE loans = loans + VALUES(loans)
+        """, sorted(book_loans.items()))
+
+
+def record_loans(cur, user_id, items):
+    """Statistics of lending `items` ({book_id: quantity}), after users.books_on_loan was raised."""
+    copies = sum(items.values())
+    # The loan counter is locked by this transaction, so it can't have moved since
+    cur.execute(LOAN_COUNTER, (user_id,))
+    first_loan = cur.fetchone()['books_on_loan'] == copies
+    record(cur, {ON_LOAN: copies, loans_on(date.today()): copies, BORROWERS: int(first_loan)}, items)
+
+
+def record_return(cur, user_id, copies):
+    """Statistics of giving back `copies`, after users.books_on_loan was lowered."""
+    cur.execute(LOAN_COUNTER, (user_id,))
+    last_loan = cur.fetchone()['books_on_loan'] == 0
+    record(cur, {ON_LOAN: -copies, BORROWERS: -int(last_loan)})
+
+
+def dashboard(cur, days=14, top=10):
+    """Everything the admin dashboard shows, from a handful of indexed reads."""
+    today = date.today()
+    daily = [loans_on(today - timedelta(days=offset)) for offset in range(days)]
+    names = [COPIES, ON_LOAN, BORROWERS, BANNED] + daily
+    placeholders = ", ".join(["%s"] * len(names))
+    cur.execute(COUNTER_VALUES.format(placeholders=placeholders), names)
+    values = {row['name']: int(row['value']) for row in cur.fetchall()}
+
+    cur.execute(TOP_TITLES, (top,))
+    return {
+        'copies': values.get(COPIES, 0),
+        'available': values.get(COPIES, 0) - values.get(ON_LOAN, 0),
+        'on_loan': values.get(ON_LOAN, 0),
+        'borrowers': values.get(BORROWERS, 0),
+        'banned': values.get(BANNED, 0),
+        'loans_per_day': [(name[len(LOANS_ON):], values.get(name, 0)) for name in daily],
+        'top_titles': cur.fetchall(),
+    }
+
+
+def rebuild(conn):
+    """Recompute the counters (but not the daily loans) and the per-book loans from the tables.
+
+    The per-book counts restart from the copies on loan now. Run it while
+    nobody borrows or returns.
+    """
+    cur = conn.cursor()
+    try:
+        counters = [COPIES, ON_LOAN, BORROWERS, BANNED]
+        placeholders = ", ".join(["%s"] * len(counters))
+        cur.execute(f"DELETE FROM library_stats WHERE name IN ({placeholders})", counters)
+        cur.execute("""
+            INSERT INTO library_stats (name, shard, value)
+            SELECT %s, 0, COALESCE(SUM(amount + on_loan + on_hold), 0) FROM books
+            UNION ALL SELECT %s, 0, COALESCE(SUM(on_loan), 0) FROM books
+            UNION ALL SELECT %s, 0, COUNT(*) FROM users WHERE books_on_loan > 0
+            UNION ALL SELECT %s, 0, COUNT(*) FROM users WHERE is_banned
+        """, counters)
+        cur.execute("DELETE FROM book_loan_stats")
+        cur.execute("""
+            INSERT INTO book_loan_stats (book_id, loans)
+            SELECT book_id, SUM(quantity) FROM user_books GROUP BY book_id
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
@@ -0,0 +1,243 @@
+"""Image uploads stored under their content hash, with resized variants.
+
+An upload is checked against the known image signatures as soon as its
+first chunk arrives, then streamed to disk while being hashed, and parsed
+by Pillow before it is put in place, so a file that merely starts like an
+image is turned down. The file is stored as `<sha256>.<ext>`, so the same picture uploaded twice (or by two
+users) is stored once and names never collide. Smaller variants for the
+templates are generated by Pillow on a background thread pool.
+
+Since one file can be shared by several users, it is only deleted once no
+user refers to it. ImageLocks keeps that check from racing an upload of
+the same picture.
+"""
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from PIL import Image
+
+CHUNK_SIZE = 64 * 1024
+
+# Longest side, in pixels, of each generated variant
+VARIANTS = {
+    'small': 300,
+}
+
+# Leading bytes of the accepted image formats
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+
+
+# Pillow's name for each accepted format
+PILLOW_FORMATS = {
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'bmp': 'BMP',
+    'webp': 'WEBP',
+}
+
+
+class InvalidImage(Exception):
+    """The upload is not an image we accept."""
+
+
+def sniff_image_type(header):
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for signature, extension in SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    return None
+
+
+def verify_image(path, extension):
+    """Raise InvalidImage unless Pillow reads `path` as a sound image of the sniffed type."""
+    try:
+        with Image.open(path) as image:
+            if image.format != PILLOW_FORMATS[extension]:
+                raise InvalidImage(f"not a valid {PILLOW_FORMATS[extension]} image")
+            image.verify()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImage("the image is damaged or too large") from e
+
+
+def save_image(file_storage, folder, locks=None):
+    """Stream an uploaded image into `folder` and return its stored filename.
+
+    With `locks` (ImageLocks), the file is put in place under its lock, and
+    the lock is left held: release it once the row referring to the file is
+    committed.
+    """
+    stream = file_storage.stream
+    first_chunk = stream.read(CHUNK_SIZE)
+    extension = sniff_image_type(first_chunk)
+    if extension is None:
+        raise InvalidImage("not a JPEG, PNG, GIF, BMP or WebP image")
+
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            chunk = first_chunk
+            while chunk:
+                digest.update(chunk)
+                tmp.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+        verify_image(tmp_path, extension)
+
+        filename = f"{digest.hexdigest()}.{extension}"
+        path = os.path.join(folder, filename)
+        if locks is not None:
+            locks.acquire(filename)
+        try:
+            if os.path.exists(path):
+                # Same content is already stored
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        except BaseException:
+            if locks is not None:
+                locks.release(filename)
+            raise
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return filename
+
+
+def variant_name(filename, variant):
+    base, extension = os.path.splitext(filename)
+    return f"{base}_{variant}{extension}"
+
+
+def make_variants(folder, filename):
+    """Write every missing variant of `filename` (runs on the thumbnail pool)."""
+    path = os.path.join(folder, filename)
+    for variant, size in VARIANTS.items():
+        variant_path = os.path.join(folder, variant_name(filename, variant))
+        if os.path.exists(variant_path):
+            continue
+        with Image.open(path) as image:
+            image_format = image.format
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA', 'L', 'P'):
+                image = image.convert('RGB')
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+            os.close(fd)
+            try:
+                image.save(tmp_path, format=image_format)
+                os.replace(tmp_path, variant_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+def delete_image(folder, filename):
+    """Remove a stored image and its variants."""
+    for name in [filename] + [variant_name(filename, variant) for variant in VARIANTS]:
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ImageLocks:
+    """One lock per stored image, shared by the processes of one host.
+
+    Storing an image and committing the row that refers to it happen under
+    its lock, as do checking that no row refers to it any more and deleting
+    it. So a delete can't remove a file that an upload of the same picture
+    has just found in place. Each image locks one byte of a lock file in the
+    upload folder (fcntl record locks, which belong to the whole process),
+    behind a thread lock for the threads of this process.
+    """
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, '.image-locks')
+        self._fd = None
+        self._guard = threading.Lock()
+        # filename -> [thread lock, threads holding or waiting for it]
+        self._locks = {}
+
+    @staticmethod
+    def _offset(filename):
+        return int.from_bytes(hashlib.blake2b(filename.encode(), digest_size=7).digest(), 'little')
+
+    def acquire(self, filename):
+        with self._guard:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            entry = self._locks.setdefault(filename, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._offset(filename))
+        except BaseException:
+            self._release_thread_lock(filename, entry)
+            raise
+
+    def release(self, filename):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset(filename))
+        with self._guard:
+            entry = self._locks[filename]
+        self._release_thread_lock(filename, entry)
+
+    def _release_thread_lock(self, filename, entry):
+        with self._guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[filename]
+        entry[0].release()
+
+    @contextmanager
+    def held(self, filename):
+        self.acquire(filename)
+        try:
+            yield
+        finally:
+            self.release(filename)
+
+
+class ThumbnailPool:
+    """Background threads generating image variants (Pillow releases the GIL while resizing)."""
+
+    def __init__(self, folder, workers=2, logger=None):
+        self.folder = folder
+        self.workers = workers
+        self.logger = logger
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix='thumbnails')
+                    self._executor_pid = pid
+        return self._executor
+
+    def submit(self, filename):
+        future = self.executor.submit(make_variants, self.folder, filename)
+        future.add_done_callback(lambda done: self._report(filename, done))
+        return future
+
+    def _report(self, filename, future):
+        error = future.exception()
+        if error is not None and self.logger is not None:
+            self.logger.warning("Could not create variants of %s: %s", filename, error)
@@ -0,0 +1,167 @@
+"""In-process cache for the User objects Flask-Login loads on every request."""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """Bounded LRU cache whose entries also expire `ttl` seconds after being stored.
+
+    If a `channel` is given, invalidations are published to it so the other
+    workers drop their copy too, and whatever they published is applied
+    before each lookup.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, channel=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.channel = channel
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # When each recently invalidated key was last invalidated
+        self._invalidated = OrderedDict()
+        self._cleared_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._apply_remote_invalidations()
+        key = str(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        key = str(key)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        key = str(key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._note_invalidation(key)
+        if self.channel is not None:
+            self.channel.publish(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._cleared_at = time.monotonic()
+
+    def invalidated_within(self, key, seconds):
+        """True if `key` was invalidated (here or by another worker) in the last `seconds`."""
+        key = str(key)
+        since = time.monotonic() - seconds
+        with self._lock:
+            return self._invalidated.get(key, float('-inf')) > since or self._cleared_at > since
+
+    def _note_invalidation(self, key):
+        self._invalidated[key] = time.monotonic()
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.maxsize:
+            self._invalidated.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+    def _apply_remote_invalidations(self):
+        if self.channel is None:
+            return
+        keys = self.channel.poll()
+        if keys is None:
+            # The channel lost track of what was published, drop everything
+            self.clear()
+            return
+        if keys:
+            with self._lock:
+                for key in keys:
+                    self._entries.pop(key, None)
+                    self._note_invalidation(key)
+
+
+class FileInvalidationChannel:
+    """Invalidation channel shared by the worker processes of one host.
+
+    Invalidated keys are appended to a log file; every process remembers how
+    far it has read, so a poll with nothing new costs a single stat(). Once
+    the log grows past `max_size` it is replaced by an empty file, and
+    readers that notice the swap flush their whole cache.
+    """
+
+    def __init__(self, path, max_size=1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        stat = self._stat()
+        # Anything published before this process started is irrelevant to it
+        self._inode = stat.st_ino if stat else None
+        self._offset = stat.st_size if stat else 0
+
+    def _stat(self):
+        try:
+            return os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+    def publish(self, key):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # A single small O_APPEND write is atomic, lines never interleave
+            os.write(fd, f"{key}\n".encode())
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+        if size > self.max_size:
+            tmp_path = f"{self.path}.{os.getpid()}"
+            open(tmp_path, 'wb').close()
+            os.replace(tmp_path, self.path)
+
+    def poll(self):
+        """Return the keys published since the last poll, or None if some may have been missed."""
+        stat = self._stat()
+        with self._lock:
+            if stat is None:
+                return []
+            if self._inode is None:
+                # The log was created after this process started
+                self._inode = stat.st_ino
+            elif stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._inode = stat.st_ino
+                self._offset = 0
+                return None
+            if stat.st_size == self._offset:
+                return []
+
+            with open(self.path, 'rb') as log:
+                log.seek(self._offset)
+                data = log.read(stat.st_size - self._offset)
+
+            # Only consume complete lines, a partial one is picked up next time
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            return data[:end].decode().split()